@@ -0,0 +1,124 @@
+from __future__ import unicode_literals
+
+from timeit import default_timer
+
+from django.db import connection, models
+from django.db.models import F, Q
+from django.db.models.sql.compiler import SQLCompiler
+from django.db.models.sql.query import Query
+from ..models.expressions import Case, SimpleCase
+from ..tests.models import CaseTestModel, BulkUpdateQuerySetTestModel
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+
+def measure(func, repeat=3):
+    """
+    Calls func repeat times and returns the fastest time in seconds, and the
+    peak memory allocated by one more call in bytes (None if tracemalloc
+    isn't available). Tracing slows down allocations, so the timed calls
+    run without it.
+    """
+    best_time = None
+    for i in range(repeat):
+        start = default_timer()
+        func()
+        seconds = default_timer() - start
+        if best_time is None or seconds < best_time:
+            best_time = seconds
+    memory = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            func()
+            memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return best_time, memory
+
+
+def compile_expression(expression):
+    query = Query(CaseTestModel)
+    compiler = SQLCompiler(query, connection, 'default')
+    return expression.resolve_expression(query).as_sql(compiler, connection)
+
+
+def bench_case_sql(branches):
+    def run():
+        compile_expression(Case(
+            [(Q(integer=i), str(i)) for i in range(branches)],
+            default='other', output_field=models.CharField()))
+    return measure(run, repeat=1 if branches > 1000 else 3)
+
+
+def bench_simple_case_sql(branches):
+    def run():
+        compile_expression(SimpleCase(
+            'integer', [(i, str(i)) for i in range(branches)],
+            default='other', output_field=models.CharField()))
+    return measure(run, repeat=1 if branches > 1000 else 3)
+
+
+def create_rows(rows):
+    BulkUpdateQuerySetTestModel.objects.all().delete()
+    BulkUpdateQuerySetTestModel.objects.bulk_create(
+        [BulkUpdateQuerySetTestModel(integer=i, string=str(i)) for i in range(rows)])
+    return list(BulkUpdateQuerySetTestModel.objects.all())
+
+
+def change_objects(objs, fields):
+    for obj in objs:
+        if 'integer' in fields:
+            obj.integer += 1
+        if 'string' in fields:
+            obj.string += 'x'
+        if 'boolean' in fields:
+            obj.boolean = not obj.boolean
+
+
+def bench_bulk_update(rows, fields, batch_size, method):
+    """
+    Times updating the fields of rows objects with bulk_update, a save()
+    loop ('save') or a single QuerySet.update() ('update').
+    """
+    objs = create_rows(rows)
+
+    def run():
+        change_objects(objs, fields)
+        if method == 'bulk_update':
+            BulkUpdateQuerySetTestModel.objects.bulk_update(
+                objs, update_fields=fields, batch_size=batch_size)
+        elif method == 'save':
+            for obj in objs:
+                obj.save(update_fields=fields)
+        else:
+            update = {'integer': F('integer') + 1, 'string': 'x', 'boolean': True}
+            BulkUpdateQuerySetTestModel.objects.update(**{f: update[f] for f in fields})
+    return measure(run, repeat=1 if rows > 1000 or method == 'save' else 3)
+
+
+def iter_benchmarks(quick=False):
+    """
+    Yields the name, parameters and benchmark function of every benchmark.
+    """
+    branch_counts = [10, 100, 1000] if quick else [10, 100, 1000, 10000, 100000]
+    for branches in branch_counts:
+        yield 'case_sql', {'branches': branches}, lambda b=branches: bench_case_sql(b)
+        yield 'simple_case_sql', {'branches': branches}, lambda b=branches: bench_simple_case_sql(b)
+
+    row_counts = [100, 1000] if quick else [100, 1000, 10000]
+    field_sets = [['integer'], ['integer', 'string', 'boolean']]
+    for rows in row_counts:
+        for fields in field_sets:
+            for batch_size in [None, 100, 1000]:
+                params = {'rows': rows, 'fields': len(fields), 'batch_size': batch_size}
+                yield ('bulk_update', params,
+                       lambda r=rows, f=fields, b=batch_size: bench_bulk_update(r, f, b, 'bulk_update'))
+            params = {'rows': rows, 'fields': len(fields)}
+            if rows <= 1000:
+                yield 'save', params, lambda r=rows, f=fields: bench_bulk_update(r, f, None, 'save')
+            yield 'update', params, lambda r=rows, f=fields: bench_bulk_update(r, f, None, 'update')
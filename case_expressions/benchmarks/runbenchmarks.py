@@ -0,0 +1,84 @@
+from __future__ import print_function, unicode_literals
+
+import argparse
+import io
+import json
+import os
+import sys
+from os.path import abspath, dirname, join
+
+
+def run(quick=False, name=None):
+    from django.db import connection
+    from case_expressions.benchmarks.benchmarks import iter_benchmarks
+
+    # destroy_test_db() puts the original name back into the settings
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    results = []
+    try:
+        for benchmark, params, func in iter_benchmarks(quick):
+            if name and benchmark != name:
+                continue
+            seconds, peak_memory = func()
+            results.append({
+                'benchmark': benchmark,
+                'params': params,
+                'seconds': seconds,
+                'peak_memory': peak_memory,
+            })
+            print(format_result(results[-1]))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+    return results
+
+
+def result_key(result):
+    return result['benchmark'], tuple(sorted(result['params'].items()))
+
+
+def format_result(result, previous=None):
+    params = ', '.join('%s=%s' % item for item in sorted(result['params'].items()))
+    line = '%-16s %-40s %10.4fs' % (result['benchmark'], params, result['seconds'])
+    if result['peak_memory'] is not None:
+        line += ' %10.1fKiB' % (result['peak_memory'] / 1024.0)
+    if previous is not None:
+        line += ' %7.2fx' % (result['seconds'] / previous['seconds'])
+    return line
+
+
+def compare(results, previous_results):
+    """
+    Prints each result next to its time relative to the previous run.
+    """
+    previous = {result_key(result): result for result in previous_results}
+    for result in results:
+        print(format_result(result, previous.get(result_key(result))))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark CASE generation and bulk_update.")
+    parser.add_argument('--quick', action='store_true', help="Skip the largest sizes.")
+    parser.add_argument('--benchmark', help="Only run the benchmark with this name.")
+    parser.add_argument('--output', help="Write the results to this JSON file.")
+    parser.add_argument('--compare', help="Compare the results to this JSON file of a previous run.")
+    args = parser.parse_args(argv)
+
+    sys.path.append(abspath(join(dirname(__file__), '..', '..')))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'case_expressions.tests.settings')
+    import django
+    django.setup()
+    from django.utils import six
+
+    results = run(args.quick, args.benchmark)
+    if args.output:
+        with io.open(args.output, 'w', encoding='utf-8') as f:
+            f.write(six.text_type(json.dumps(results, indent=2, sort_keys=True)))
+    if args.compare:
+        with io.open(args.compare, encoding='utf-8') as f:
+            print('\nCompared to %s:' % args.compare)
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
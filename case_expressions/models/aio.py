@@ -0,0 +1,130 @@
+"""
+An asyncio version of BulkUpdateQuerySet.bulk_update (Python 3.5+ only).
+"""
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer
+
+from django.db import DatabaseError, connections, transaction
+from .query import BulkUpdateResult
+from .strategies import BaseUpdateStrategy, get_update_strategy
+
+
+async def _next_batch(objs, size):
+    """
+    Returns up to size objects from an iterator or an async iterator.
+    """
+    batch = []
+    try:
+        while len(batch) < size:
+            if hasattr(objs, '__anext__'):
+                batch.append(await objs.__anext__())
+            else:
+                batch.append(next(objs))
+    except (StopIteration, StopAsyncIteration):
+        pass
+    return batch
+
+
+async def abulk_update(self, objs, update_fields=None, batch_size=None, strategy=None):
+    """
+    A coroutine that updates each of the instances like bulk_update, from an
+    iterable or an async iterable, and returns a BulkUpdateResult. Each
+    batch is updated, and reported with the bulk_update_batch signal, the
+    same way as by bulk_update.
+
+    All queries run in one transaction on a thread of their own, with its
+    own connection. The SQL of the next batch is built on another thread
+    while the current batch executes, and the event loop keeps running in
+    between. Both threads close their connections when the update ends.
+    Cancelling the task stops the update after the batch that is executing,
+    and rolls back the transaction.
+    """
+    assert batch_size is None or batch_size > 0
+    if self.model._meta.parents:
+        raise ValueError("Can't bulk update an inherited model")
+    self._for_write = True
+    using = self.db
+    fields = self._get_update_fields(update_fields)
+    strategy = get_update_strategy(self.model, connections[using], strategy)
+    if not batch_size:
+        batch_size = max(strategy.batch_size(
+            fields, range(self.iterator_batch_size), connections[using]), 1)
+    # strategies that send data in prepare() or split batches can't build
+    # SQL ahead of time
+    pipelined = (type(strategy).prepare is BaseUpdateStrategy.prepare and
+                 type(strategy).batch_limit is BaseUpdateStrategy.batch_limit)
+    if hasattr(objs, '__aiter__'):
+        objs = objs.__aiter__()
+    else:
+        objs = iter(objs)
+
+    loop = asyncio.get_event_loop()
+    db_executor = ThreadPoolExecutor(max_workers=1)
+    build_executor = ThreadPoolExecutor(max_workers=1)
+    atomic = transaction.atomic(using=using, savepoint=False)
+
+    def build(batch):
+        start = default_timer()
+        sql, params = strategy.as_sql(batch, fields, connections[using])
+        return sql, params, default_timer() - start
+
+    def execute(batch, index, prebuilt=None):
+        # like a batch of bulk_update, which also sends the signal
+        return self._update_many(batch, fields, using, strategy, batch=index, prebuilt=prebuilt)
+
+    def finish(exc_info):
+        connection = connections[using]
+        try:
+            try:
+                strategy.finish(connection)
+            except DatabaseError:
+                # roll back, without hiding the error the update failed with
+                if exc_info[0] is None:
+                    atomic.__exit__(*sys.exc_info())
+                    raise
+            atomic.__exit__(*exc_info)
+        finally:
+            connection.close()
+
+    def close():
+        # connections are per thread
+        connections[using].close()
+
+    rows = 0
+    executing = None
+    await loop.run_in_executor(db_executor, atomic.__enter__)
+    try:
+        index = 0
+        while True:
+            batch = await _next_batch(objs, batch_size)
+            if not batch:
+                break
+            if any(o.pk is None for o in batch):
+                raise ValueError("Can't bulk update instances without a pk")
+            built = None
+            if pipelined:
+                built = await loop.run_in_executor(build_executor, build, batch)
+            if executing is not None:
+                rows += await executing
+            executing = loop.run_in_executor(db_executor, execute, batch, index, built)
+            index += 1
+        if executing is not None:
+            rows += await executing
+            executing = None
+    except BaseException as e:
+        # queries run in order on the database thread, so the rollback waits
+        # for the batch that is still executing
+        await loop.run_in_executor(db_executor, finish, (type(e), e, e.__traceback__))
+        raise
+    else:
+        await loop.run_in_executor(db_executor, finish, (None, None, None))
+    finally:
+        try:
+            if pipelined:
+                await loop.run_in_executor(build_executor, close)
+        finally:
+            db_executor.shutdown(wait=False)
+            build_executor.shutdown(wait=False)
+    return BulkUpdateResult(rows)
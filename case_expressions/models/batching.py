@@ -0,0 +1,88 @@
+from __future__ import unicode_literals
+
+from collections import namedtuple
+
+
+BackendLimits = namedtuple('BackendLimits', ['max_params', 'max_sql_length', 'inlines_params'])
+
+# limits that can't change while the process runs, by connection alias
+_backend_limits = {}
+
+
+def get_backend_limits(connection):
+    """
+    Returns the maximum number of parameters and the maximum length in bytes
+    of a single statement for the connection, either of which may be None
+    when the backend has no practical limit, and whether the parameters are
+    interpolated into the statement before it is sent.
+    """
+    try:
+        return _backend_limits[connection.alias]
+    except KeyError:
+        pass
+    vendor = connection.vendor
+    if vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        # SQLITE_MAX_VARIABLE_NUMBER and SQLITE_MAX_SQL_LENGTH defaults
+        max_params = 32766 if Database.sqlite_version_info >= (3, 32, 0) else 999
+        limits = BackendLimits(max_params, 1000000, False)
+    elif vendor == 'mysql':
+        # MySQLdb interpolates the parameters, so the statement has to fit in
+        # a single packet
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT @@max_allowed_packet')
+            max_allowed_packet = cursor.fetchone()[0]
+        limits = BackendLimits(None, max_allowed_packet, True)
+    elif vendor == 'postgresql':
+        # psycopg2 interpolates the parameters, and a statement can't be
+        # longer than 1GB
+        limits = BackendLimits(None, 2 ** 30 - 1, True)
+    elif vendor == 'oracle':
+        limits = BackendLimits(65535, None, False)
+    else:
+        limits = BackendLimits(None, None, False)
+    _backend_limits[connection.alias] = limits
+    return limits
+
+
+def estimate_value_length(field):
+    """
+    Returns an upper estimate of the length of a field's value when it is
+    interpolated into a statement.
+    """
+    max_length = getattr(field, 'max_length', None)
+    if max_length:
+        # quotes and escaping, with up to 4 bytes per character
+        return max_length * 4 + 3
+    return 64
+
+
+class AdaptiveBatchSize(object):
+    """
+    Chooses the number of objects in each batch of a bulk update. The size
+    never exceeds the ceiling (from the backend's limits), and within it is
+    tuned after every batch so that a batch takes about target_time seconds.
+    """
+    def __init__(self, ceiling, target_time, initial_size=100, smoothing=0.5):
+        assert target_time > 0
+        self.ceiling = max(ceiling, 1)
+        self.target_time = target_time
+        self.smoothing = smoothing
+        self.size = min(initial_size, self.ceiling)
+
+    def record(self, rows, seconds):
+        """
+        Updates the size from the time a batch of rows took.
+        """
+        if rows <= 0:
+            return
+        if seconds <= 0:
+            wanted = self.size * 2
+        else:
+            wanted = rows / seconds * self.target_time
+        # smooth out noise and grow at most twice as large per batch
+        size = int(self.smoothing * self.size + (1 - self.smoothing) * wanted)
+        size = max(1, min(size, self.size * 2, self.ceiling))
+        # keep to a few distinct sizes, so the compiled SQL can be reused
+        step = 1 << max(size.bit_length() - 3, 0)
+        self.size = min((size + step // 2) // step * step, self.ceiling)
@@ -0,0 +1,197 @@
+from __future__ import unicode_literals
+
+import operator
+
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import F, Value
+from django.db.models.query_utils import Q
+from django.db.models.sql.constants import QUERY_TERMS
+from django.db.models.sql.where import AND
+from django.utils import six
+from .expressions import BaseCaseExpression, Case, SimpleCase
+
+
+def _compare(op):
+    # comparisons with NULL are never true
+    def compare(value, other):
+        return value is not None and other is not None and op(value, other)
+    return compare
+
+
+def _exact(value, other):
+    if other is None:
+        # Q(field=None) is an isnull lookup
+        return value is None
+    return value is not None and value == other
+
+
+def _in(value, other):
+    return value is not None and value in other
+
+
+def _contains(value, other):
+    return value is not None and other is not None and other in value
+
+
+def _isnull(value, other):
+    return (value is None) == bool(other)
+
+
+LOOKUPS = {
+    'exact': _exact,
+    'in': _in,
+    'gt': _compare(operator.gt),
+    'gte': _compare(operator.ge),
+    'lt': _compare(operator.lt),
+    'lte': _compare(operator.le),
+    'isnull': _isnull,
+    'contains': _contains,
+}
+
+
+def _divide(value, other):
+    if isinstance(value, six.integer_types) and isinstance(other, six.integer_types):
+        # integer division truncates towards zero in SQL
+        quotient = abs(value) // abs(other)
+        return quotient if (value < 0) == (other < 0) else -quotient
+    return value / other
+
+
+CONNECTORS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': _divide,
+    '^': operator.pow,
+    '%%': operator.mod,
+    '&': operator.and_,
+    '|': operator.or_,
+}
+
+
+def get_value(row, name):
+    """
+    Returns the value of a field (following relations separated by __) from
+    a model instance or a dict.
+    """
+    if isinstance(row, dict) and name in row:
+        return row[name]
+    for part in name.split(LOOKUP_SEP):
+        if row is None:
+            return None
+        row = row[part] if isinstance(row, dict) else getattr(row, part)
+    return row
+
+
+def compile_expression(expression):
+    """
+    Returns a function that computes the value of an unresolved expression
+    for a row. Supports Case, SimpleCase, F, Value and arithmetic combining
+    them. Raises ValueError for anything else.
+    """
+    if isinstance(expression, BaseCaseExpression):
+        expression = expression.optimize()
+    if isinstance(expression, Case):
+        return _compile_case(expression)
+    if isinstance(expression, SimpleCase):
+        return _compile_simple_case(expression)
+    if isinstance(expression, F):
+        name = expression.name
+        return lambda row: get_value(row, name)
+    if isinstance(expression, Value):
+        value = expression.value
+        return lambda row: value
+    if hasattr(expression, 'connector') and hasattr(expression, 'lhs'):
+        try:
+            op = CONNECTORS[expression.connector]
+        except KeyError:
+            raise ValueError("Unsupported connector '%s'." % expression.connector)
+        lhs, rhs = compile_expression(expression.lhs), compile_expression(expression.rhs)
+
+        def combine(row):
+            value, other = lhs(row), rhs(row)
+            if value is None or other is None:
+                return None
+            return op(value, other)
+        return combine
+    raise ValueError("Can't evaluate %r in Python." % expression)
+
+
+def compile_condition(q):
+    """
+    Returns a function that tests a row against a Q object. Raises
+    ValueError for lookups other than those in LOOKUPS.
+    """
+    tests = []
+    for child in q.children:
+        if isinstance(child, Q):
+            tests.append(compile_condition(child))
+        else:
+            tests.append(_compile_lookup(*child))
+    combine = all if q.connector == AND else any
+    if q.negated:
+        return lambda row: not combine(test(row) for test in tests)
+    return lambda row: combine(test(row) for test in tests)
+
+
+def _compile_lookup(lookup, other):
+    parts = lookup.split(LOOKUP_SEP)
+    lookup_name = 'exact'
+    if len(parts) > 1 and parts[-1] in QUERY_TERMS:
+        lookup_name = parts.pop()
+        if lookup_name not in LOOKUPS:
+            raise ValueError("Can't evaluate the lookup '%s' in Python." % lookup_name)
+    name = LOOKUP_SEP.join(parts)
+    test = LOOKUPS[lookup_name]
+    if hasattr(other, 'resolve_expression'):
+        rhs = compile_expression(other)
+        return lambda row: test(get_value(row, name), rhs(row))
+    if lookup_name == 'in':
+        other = list(other)
+    return lambda row: test(get_value(row, name), other)
+
+
+def _compile_case(expression):
+    branches = [(compile_condition(condition), compile_expression(value))
+                for condition, value in expression.values]
+    default = _compile_default(expression)
+
+    def case(row):
+        for condition, value in branches:
+            if condition(row):
+                return value(row)
+        return default(row)
+    return case
+
+
+def _compile_simple_case(expression):
+    operand = compile_expression(F(expression.name))
+    branches = [(compile_expression(condition), compile_expression(value))
+                for condition, value in expression.values]
+    default = _compile_default(expression)
+
+    def simple_case(row):
+        value = operand(row)
+        if value is not None:
+            for condition, result in branches:
+                if condition(row) == value:
+                    return result(row)
+        return default(row)
+    return simple_case
+
+
+def _compile_default(expression):
+    if expression.default is None:
+        return lambda row: None
+    return compile_expression(expression.default)
+
+
+def evaluate(expression, rows):
+    """
+    Computes the value of an unresolved Case or SimpleCase expression for
+    each of the rows (model instances or dicts of field values), as the
+    database would for the same rows. The expression is compiled once for
+    the whole list.
+    """
+    func = compile_expression(expression)
+    return [func(row) for row in rows]
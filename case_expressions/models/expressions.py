@@ -1,14 +1,79 @@
 from __future__ import unicode_literals
 
-from django.db.models.expressions import ExpressionNode, F, Value
+import copy
+import weakref
+from collections import OrderedDict
+from functools import reduce
+from operator import or_
+
+from django.db import router
+from django.db.models.expressions import Col, ExpressionNode, F, Value
+from django.db.models.fields import AutoField, BooleanField, IntegerField
 from django.db.models.query_utils import Q
+from django.db.models.sql.constants import LOUTER
+from django.db.models.sql.query import Query
 from django.db.models.sql.where import WhereNode, AND
 
 
+def expression_key(expression):
+    """
+    Returns a hashable key that is equal for unresolved expressions that
+    always compile to the same SQL, or None if that can't be determined.
+    """
+    if isinstance(expression, Q):
+        return q_key(expression)
+    if type(expression) is F:
+        return ('F', expression.name)
+    if isinstance(expression, Value):
+        return value_key(expression.value)
+    if isinstance(expression, BaseCaseExpression):
+        return expression.key()
+    return None
+
+
+def value_key(value):
+    if hasattr(value, 'resolve_expression'):
+        return expression_key(value)
+    if isinstance(value, (list, tuple)):
+        keys = tuple(value_key(v) for v in value)
+        return None if None in keys else ('sequence', keys)
+    try:
+        hash(value)
+    except TypeError:
+        return None
+    # 1 and True are equal, but not the same parameter
+    return ('value', type(value), value)
+
+
+def q_key(q):
+    """
+    Returns a hashable key that is equal for Q objects with the same
+    structure, lookups and values in any order, or None if any of the values
+    isn't hashable.
+    """
+    children = []
+    for child in q.children:
+        if isinstance(child, Q):
+            key = q_key(child)
+        else:
+            lookup, value = child
+            key = value_key(value)
+            key = None if key is None else (lookup, key)
+        if key is None:
+            return None
+        children.append(key)
+    # the order of the children doesn't change the result (and Q(**kwargs)
+    # doesn't keep it on every Python version)
+    return ('Q', q.connector, q.negated, frozenset(children))
+
+
 class BaseCaseExpression(ExpressionNode):
     class NoDefault:
         pass
 
+    # whether optimize() already ran on the expression
+    optimized = False
+
     def __init__(self, values=None, default=NoDefault(), output_field=None):
         super(BaseCaseExpression, self).__init__(output_field)
         self.values = self.init_values(values)
@@ -25,7 +90,12 @@ class BaseCaseExpression(ExpressionNode):
         raise NotImplementedError("Subclasses must implement init_values()")
 
     def get_source_expressions(self):
-        source_expressions = [value for condition, value in self.values]
+        # conditions are only expressions once they are resolved
+        source_expressions = []
+        for condition, value in self.values:
+            if hasattr(condition, 'as_sql'):
+                source_expressions.append(condition)
+            source_expressions.append(value)
         if self.default is not None:
             source_expressions.append(self.default)
         return source_expressions
@@ -34,15 +104,131 @@ class BaseCaseExpression(ExpressionNode):
         if self.default is not None:
             self.default = exprs[-1]
             exprs = exprs[:-1]
-        self.values = [(condition, new_value) for new_value, (condition, value) in zip(exprs, self.values)]
+        exprs = iter(exprs)
+        self.values = [(next(exprs) if hasattr(condition, 'as_sql') else condition, next(exprs))
+                       for condition, value in self.values]
+
+    def get_source_fields(self):
+        # only the results determine the type of the expression
+        source_fields = [value._output_field_or_none for condition, value in self.values]
+        if self.default is not None:
+            source_fields.append(self.default._output_field_or_none)
+        return source_fields
+
+    def key(self):
+        """
+        Returns a hashable key that is equal for expressions with the same
+        type, branches, default and output field, or None (see
+        expression_key).
+        """
+        keys = []
+        for condition, value in self.values:
+            condition_key, result_key = expression_key(condition), expression_key(value)
+            if condition_key is None or result_key is None:
+                return None
+            keys.append((condition_key, result_key))
+        default_key = None if self.default is None else expression_key(self.default)
+        if self.default is not None and default_key is None:
+            return None
+        output_type = None if self._output_field is None else type(self._output_field)
+        return (type(self), output_type, tuple(keys), default_key)
+
+    def optimize(self):
+        """
+        Returns an equivalent expression that is cheaper to evaluate: nested
+        defaults of the same type are flattened, branches that can't match or
+        only lead to the default are dropped, adjacent branches with the same
+        result are merged, and an expression with a single result becomes
+        just that result.
+        """
+        values, default = self.values, self.default
+        while type(default) is type(self) and self.can_flatten(default):
+            values = values + default.values
+            default = default.default
+
+        optimized = []
+        seen = set()
+        for condition, value in values:
+            if self.is_always_true(condition):
+                default = value
+                break
+            key = expression_key(condition)
+            if key is not None:
+                # only the first of duplicate conditions can match
+                if key in seen:
+                    continue
+                seen.add(key)
+            optimized.append((condition, value))
+
+        if default is not None:
+            default_key = expression_key(default)
+            while (optimized and default_key is not None and
+                    expression_key(optimized[-1][1]) == default_key):
+                optimized.pop()
+            if not optimized:
+                if isinstance(default, Value) and self._output_field is not None:
+                    default = Value(default.value, output_field=self._output_field)
+                return default
+
+        groups = []
+        for condition, value in optimized:
+            key = expression_key(value)
+            if groups and key is not None and key == groups[-1][0]:
+                groups[-1][1].append(condition)
+            else:
+                groups.append((key, [condition], value))
+        return self.merge_branches([(conditions, value) for key, conditions, value in groups], default)
+
+    def can_flatten(self, default):
+        return True
+
+    def is_always_true(self, condition):
+        return False
+
+    def merge_branches(self, groups, default):
+        """
+        Returns the optimized expression from the groups of adjacent
+        conditions with the same result.
+        """
+        raise NotImplementedError("Subclasses must implement merge_branches()")
+
+    def optimized_copy(self, values, default):
+        c = self.copy()
+        c.values = values
+        c.default = default
+        c.optimized = True
+        return c
+
+    def materialized_column(self, query, reuse=None, summarize=False):
+        """
+        Returns the column that stores the value of the expression for the
+        query's model (see materialize()) as a resolved expression, or None.
+        """
+        if self.optimized or getattr(query, 'model', None) is None:
+            return None
+        columns = getattr(query.model._meta.concrete_model._meta, 'materialized_columns', None)
+        if not columns:
+            return None
+        key = expression_key(self)
+        field = None if key is None else columns.get(key)
+        if field is None:
+            return None
+        # materialized expressions only refer to the model's own fields, and
+        # resolving them without joins keeps lookups from joining their lists
+        return MaterializedColumn(Col(query.get_initial_alias(), field),
+                                  self.optimize().resolve_expression(query, False, reuse, summarize))
 
     def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False):
+        column = self.materialized_column(query, reuse, summarize)
+        if column is not None:
+            return column
+        if not self.optimized:
+            return self.optimize().resolve_expression(query, allow_joins, reuse, summarize)
         c = self.copy()
         c.is_summary = summarize
         values = []
         for condition, value in c.values:
-            if hasattr(condition, 'resolve_expression'):
-                condition = condition.resolve_expression(query, allow_joins, reuse, summarize)
+            condition = c.resolve_condition(condition, query, allow_joins, reuse, summarize)
             value = value.resolve_expression(query, allow_joins, reuse, summarize)
             values.append((condition, value))
         c.values = values
@@ -50,6 +236,11 @@ class BaseCaseExpression(ExpressionNode):
             c.default = c.default.resolve_expression(query, allow_joins, reuse, summarize)
         return c
 
+    def resolve_condition(self, condition, query=None, allow_joins=True, reuse=None, summarize=False):
+        if hasattr(condition, 'resolve_expression'):
+            condition = condition.resolve_expression(query, allow_joins, reuse, summarize)
+        return condition
+
     def predicate_sql(self, compiler, connection):
         raise NotImplementedError("Subclasses must implement predicate_sql()")
 
@@ -90,6 +281,120 @@ class BaseCaseExpression(ExpressionNode):
             result_params)
 
 
+class Condition(ExpressionNode):
+    """
+    A Q object resolved to a where node, so it can be compiled like any other
+    expression.
+    """
+    def __init__(self, where):
+        super(Condition, self).__init__(output_field=BooleanField())
+        self.where = where
+        self._compiled = None
+
+    @property
+    def contains_aggregate(self):
+        return self.where.contains_aggregate
+
+    def relabeled_clone(self, change_map):
+        clone = self.copy()
+        clone.where = self.where.relabeled_clone(change_map)
+        clone._compiled = None
+        return clone
+
+    def get_group_by_cols(self):
+        return self.where.get_group_by_cols()
+
+    def as_sql(self, compiler, connection):
+        # a condition shared by several expressions is only compiled once per
+        # compiler, which is only referenced weakly, as it references the query
+        if self._compiled is None or self._compiled[0]() is not compiler:
+            self._compiled = (weakref.ref(compiler), compiler.compile(self.where))
+        sql, params = self._compiled[1]
+        return sql, list(params)
+
+
+def resolve_q(q, query, where_class=WhereNode):
+    """
+    Adds the joins a Q object needs to the query and returns it as a
+    Condition. Equal Q objects (see q_key) resolved against the same query
+    share a single Condition.
+    """
+    key = q_key(q)
+    if key is not None:
+        # the prefix changes when the query's aliases are relabeled
+        key = (query.alias_prefix, where_class, key)
+        # kept on the query, so they live exactly as long as it does
+        conditions = query.__dict__.setdefault('_resolved_conditions', {})
+        if key in conditions:
+            return conditions[key]
+    clause, require_inner = query._add_q(q, query.used_aliases)
+    when = where_class()
+    when.add(clause, AND)
+    condition = Condition(when)
+    if key is not None:
+        conditions[key] = condition
+    return condition
+
+
+def materialize(model, column, expression):
+    """
+    Records a column of the model's table that stores the value of a Case
+    or SimpleCase expression for each row, like the generated column added
+    by the AddGeneratedColumn migration operation, in the model's options.
+    Querysets of the model then read the column instead of an identical
+    expression, on the databases the model is migrated on.
+    """
+    key = expression_key(expression)
+    if key is None:
+        raise ValueError("Only expressions of constants, fields and Q objects can be materialized.")
+    opts = model._meta.concrete_model._meta
+    query = Query(opts.model)
+    query.get_initial_alias()
+    resolved = expression.resolve_expression(query, allow_joins=False)
+    if len(query.tables) > 1:
+        raise ValueError("The expression can only refer to the model's own fields.")
+    field = copy.copy(resolved.output_field)
+    field.set_attributes_from_name(column)
+    field.model = opts.model
+    # a copy, so the change doesn't show in models rendered from the same dict
+    columns = dict(getattr(opts, 'materialized_columns', {}))
+    columns[key] = field
+    opts.materialized_columns = columns
+
+
+def dematerialize(model, expression):
+    """
+    Removes a column recorded with materialize().
+    """
+    opts = model._meta.concrete_model._meta
+    columns = dict(getattr(opts, 'materialized_columns', {}))
+    columns.pop(expression_key(expression), None)
+    opts.materialized_columns = columns
+
+
+class MaterializedColumn(ExpressionNode):
+    """
+    The column that stores the value of an expression (see materialize()).
+    It's compiled to the expression itself on databases that the router
+    doesn't migrate the model on, which don't have the column.
+    """
+    def __init__(self, col, expression):
+        super(MaterializedColumn, self).__init__(output_field=col.output_field)
+        self.col = col
+        self.expression = expression
+
+    def get_source_expressions(self):
+        return [self.col, self.expression]
+
+    def set_source_expressions(self, exprs):
+        self.col, self.expression = exprs
+
+    def as_sql(self, compiler, connection):
+        if router.allow_migrate(connection.alias, self.col.target.model):
+            return compiler.compile(self.col)
+        return compiler.compile(self.expression)
+
+
 class Case(BaseCaseExpression):
     """
     An SQL searched CASE expression:
@@ -120,15 +425,116 @@ class Case(BaseCaseExpression):
 
         return init_values
 
+    def is_always_true(self, condition):
+        return isinstance(condition, Q) and not condition.children
+
+    def merge_branches(self, groups, default):
+        values = []
+        for conditions, value in groups:
+            if len(conditions) > 1 and all(isinstance(c, Q) for c in conditions):
+                values.append((reduce(or_, conditions), value))
+            else:
+                values.extend((condition, value) for condition in conditions)
+        return self.optimized_copy(values, default)
+
+    def key(self):
+        key = super(Case, self).key()
+        return None if key is None else key + (self.where_class,)
+
+    def can_flatten(self, default):
+        return default.where_class is self.where_class
+
+    def resolve_condition(self, condition, query=None, allow_joins=True, reuse=None, summarize=False):
+        # resolve Q objects once, so they don't need resolving when compiling
+        if not isinstance(condition, Q):
+            return super(Case, self).resolve_condition(condition, query, allow_joins, reuse, summarize)
+        return resolve_q(condition, query, self.where_class)
+
     def predicate_sql(self, compiler, connection):
         return '', ()
 
     def condition_sql(self, condition, compiler, connection):
-        query = compiler.query
-        clause, require_inner = query._add_q(condition, query.used_aliases)
-        when = self.where_class()
-        when.add(clause, AND)
-        return compiler.compile(when)
+        return compiler.compile(condition)
+
+
+class LookupJoin(object):
+    """
+    The VALUES list of a SimpleCase lookup, joined to the query like a table
+    (see Query.alias_map):
+
+        LEFT OUTER JOIN (VALUES (1, 'one'), (2, 'two')) lookup
+            ON (lookup.column1 = t.n)
+
+    PostgreSQL types the columns of the list from its first row, which is
+    cast to the types of the operand and the result; untyped, the columns
+    would be text. Backends not in values_vendors join a union of SELECTs
+    instead.
+    """
+    table_name = 'lookup'
+    join_type = LOUTER
+    nullable = True
+    values_vendors = ('postgresql', 'sqlite')
+
+    def __init__(self, parent_alias, column, values, key_field, output_field, table_alias=None):
+        self.parent_alias = parent_alias
+        self.column = column
+        self.values = values
+        self.key_field = key_field
+        self.output_field = output_field
+        self.table_alias = table_alias
+
+    @staticmethod
+    def cast_type(field, connection):
+        if isinstance(field, AutoField):
+            # like a foreign key to the field
+            return IntegerField().db_type(connection)
+        return field.db_type(connection)
+
+    def as_sql(self, compiler, connection):
+        qn = compiler.quote_name_unless_alias
+        qn2 = connection.ops.quote_name
+        rows = []
+        params = []
+        for condition, value in self.values:
+            condition_sql, condition_params = compiler.compile(condition)
+            value_sql, value_params = compiler.compile(value)
+            if not rows and connection.vendor == 'postgresql':
+                condition_sql = 'CAST(%s AS %s)' % (condition_sql, self.cast_type(self.key_field, connection))
+                value_sql = 'CAST(%s AS %s)' % (value_sql, self.cast_type(self.output_field, connection))
+            rows.append((condition_sql, value_sql))
+            params.extend(condition_params)
+            params.extend(value_params)
+        if connection.vendor in self.values_vendors:
+            table = 'VALUES %s' % ', '.join('(%s, %s)' % row for row in rows)
+        else:
+            table = ' UNION ALL '.join(
+                'SELECT %s AS %s, %s AS %s%s' % (
+                    condition_sql, qn2('column1'), value_sql, qn2('column2'),
+                    ' FROM DUAL' if connection.vendor == 'oracle' else '')
+                for condition_sql, value_sql in rows)
+        alias = qn(self.table_alias)
+        return '%s (%s) %s ON (%s.%s = %s.%s)' % (
+            self.join_type, table, alias, alias, qn2('column1'),
+            qn(self.parent_alias), qn2(self.column)), params
+
+    def relabeled_clone(self, change_map):
+        return self.__class__(
+            change_map.get(self.parent_alias, self.parent_alias), self.column, self.values,
+            self.key_field, self.output_field, change_map.get(self.table_alias, self.table_alias))
+
+    def key(self):
+        return (self.parent_alias, self.column, tuple(
+            (value_key(condition.value), value_key(value.value)) for condition, value in self.values),
+            type(self.output_field))
+
+    def __eq__(self, other):
+        # Query.join() reuses an equal join
+        return isinstance(other, LookupJoin) and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = object.__hash__
 
 
 class SimpleCase(BaseCaseExpression, F):
@@ -142,11 +548,28 @@ class SimpleCase(BaseCaseExpression, F):
                 THEN 'two'
             ELSE 'I cannot count that high'
         END
+
+    With lookup=True, a mapping of constants to constants is compiled to a
+    join of an inline VALUES list instead (see LookupJoin). The database can
+    hash the list instead of walking a long CASE expression for every row:
+
+        SELECT COALESCE(lookup.column2, 'I cannot count that high')
+        FROM t LEFT OUTER JOIN (VALUES (1, 'one'), (2, 'two')) lookup
+            ON (lookup.column1 = t.n)
+
+    Mappings with expressions, mappings to NULL with a default (which
+    COALESCE would replace) and expressions resolved without joins (as in
+    QuerySet.update()) are still compiled to a CASE expression.
     """
-    def __init__(self, name, values=None, default=BaseCaseExpression.NoDefault(), output_field=None):
+
+    def __init__(self, name, values=None, default=BaseCaseExpression.NoDefault(), output_field=None,
+                 lookup=False):
         super(SimpleCase, self).__init__(values, default, output_field)
         F.__init__(self, name)
         self.col = None
+        self.lookup = lookup
+        # the alias of the resolved expression's LookupJoin
+        self.lookup_alias = None
 
     def init_values(self, values):
         init_values = []
@@ -163,39 +586,350 @@ class SimpleCase(BaseCaseExpression, F):
 
         return init_values
 
+    def key(self):
+        key = super(SimpleCase, self).key()
+        return None if key is None else key + (self.name, self.lookup)
+
     def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False):
+        column = self.materialized_column(query, reuse, summarize)
+        if column is not None:
+            return column
+        if not self.optimized:
+            return self.optimize().resolve_expression(query, allow_joins, reuse, summarize)
         c = super(SimpleCase, self).resolve_expression(query, allow_joins, reuse, summarize)
         c.col = F.resolve_expression(self, query, allow_joins, reuse, summarize)
+        values = None
+        if c.lookup and c.values and allow_joins and isinstance(c.col, Col):
+            values = c.lookup_values(c.col.target)
+        if values is not None:
+            c.lookup_alias = query.join(LookupJoin(
+                c.col.alias, c.col.target.column, values, c.col.target, c.output_field))
         return c
 
+    def relabeled_clone(self, change_map):
+        clone = super(SimpleCase, self).relabeled_clone(change_map)
+        if self.col is not None:
+            clone.col = self.col.relabeled_clone(change_map)
+        if self.lookup_alias is not None:
+            clone.lookup_alias = change_map.get(self.lookup_alias, self.lookup_alias)
+        return clone
+
     def predicate_sql(self, compiler, connection):
         return self.col.as_sql(compiler, connection)
 
     def condition_sql(self, condition, compiler, connection):
         return condition.as_sql(compiler, connection)
 
+    def can_flatten(self, default):
+        return default.name == self.name
+
+    def merge_branches(self, groups, default):
+        """
+        A simple CASE expression can't compare the operand to a list, so
+        when adjacent keys share a result it is turned into a searched CASE
+        expression with IN lookups instead (unless it is a lookup).
+        """
+        values = [(condition, value) for conditions, value in groups for condition in conditions]
+        # a NULL key never matches, but the isnull lookup it would become does
+        if (self.lookup or all(len(conditions) == 1 for conditions, value in groups) or
+                any(isinstance(condition, Value) and condition.value is None
+                    for condition, value in values)):
+            return self.optimized_copy(values, default)
+        values = []
+        for conditions, value in groups:
+            if len(conditions) > 1 and all(isinstance(c, Value) for c in conditions):
+                values.append((Q(**{'%s__in' % self.name: [c.value for c in conditions]}), value))
+            else:
+                values.extend((Q(**{self.name: c.value if isinstance(c, Value) else c}), value)
+                              for c in conditions)
+        if default is None:
+            default = BaseCaseExpression.NoDefault()
+        return Case(values, default, self._output_field).optimize()
+
+    def lookup_values(self, key_field):
+        """
+        Returns the (condition, value) pairs of the lookup, keeping the first
+        of duplicate conditions like CASE does, or None if the values can't
+        be looked up. Conditions are compared as values of the key field,
+        like the database compares them to the column.
+        """
+        seen = set()
+        values = []
+        for condition, value in self.values:
+            if not isinstance(condition, Value) or not isinstance(value, Value):
+                return None
+            if value.value is None and self.default is not None:
+                return None
+            try:
+                key = key_field.get_prep_value(condition.value)
+                if key in seen:
+                    continue
+                seen.add(key)
+            except (TypeError, ValueError):
+                # unhashable, or not a value of the field
+                return None
+            values.append((condition, value))
+        return values
+
+    def lookup_sql(self, compiler, connection):
+        sql = '%s.%s' % (compiler.quote_name_unless_alias(self.lookup_alias),
+                         connection.ops.quote_name('column2'))
+        params = []
+        if self.default is not None:
+            default_sql, default_params = self.default.as_sql(compiler, connection)
+            sql = 'COALESCE(%s, %s)' % (sql, default_sql)
+            params.extend(default_params)
+        output_field = self.output_field
+        return (
+            connection.ops.field_cast_sql(
+                output_field.db_type(connection),
+                output_field.get_internal_type()) % sql,
+            params)
+
+    def as_sql(self, compiler, connection):
+        if self.lookup_alias is not None:
+            return self.lookup_sql(compiler, connection)
+        return super(SimpleCase, self).as_sql(compiler, connection)
+
+
+class Filter(ExpressionNode):
+    """
+    An aggregate over only the rows that match a condition:
+
+        SUM(value) FILTER (WHERE payed)
+
+    Backends without the FILTER clause aggregate a CASE expression instead:
+
+        SUM(CASE WHEN payed THEN value END)
+
+    Equal conditions of several aggregates in the same query are resolved
+    and compiled once.
+    """
+    contains_aggregate = True
+
+    def __init__(self, aggregate, condition, where=WhereNode):
+        super(Filter, self).__init__()
+        if not isinstance(condition, Q):
+            raise TypeError("The condition must be a Q object.")
+        self.aggregate = aggregate
+        self.condition = condition
+        self.where_class = where
+
+    def get_source_expressions(self):
+        # the condition is only an expression once it is resolved
+        if hasattr(self.condition, 'as_sql'):
+            return [self.aggregate, self.condition]
+        return [self.aggregate]
+
+    def set_source_expressions(self, exprs):
+        self.aggregate = exprs[0]
+        if len(exprs) > 1:
+            self.condition = exprs[1]
+
+    def get_source_fields(self):
+        return [self.aggregate._output_field_or_none]
+
+    def get_group_by_cols(self):
+        return []
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False):
+        c = self.copy()
+        c.is_summary = summarize
+        c.aggregate = c.aggregate.resolve_expression(query, allow_joins, reuse, summarize)
+        c.condition = resolve_q(c.condition, query, self.where_class)
+        return c
+
+    @staticmethod
+    def supports_filter(connection):
+        if connection.vendor == 'postgresql':
+            return connection.pg_version >= 90400
+        if connection.vendor == 'sqlite':
+            from django.db.backends.sqlite3.base import Database
+            return Database.sqlite_version_info >= (3, 30, 0)
+        return False
+
+    def as_sql(self, compiler, connection):
+        if self.supports_filter(connection):
+            sql, params = compiler.compile(self.aggregate)
+            condition_sql, condition_params = compiler.compile(self.condition)
+            return '%s FILTER (WHERE %s)' % (sql, condition_sql), list(params) + condition_params
+        aggregate = self.aggregate.copy()
+        source = aggregate.get_source_expressions()[0]
+        output_field = source._output_field_or_none
+        if getattr(source, 'value', None) == '*' or compiler.compile(source)[0] == '*':
+            # COUNT(*) counts the rows the CASE expression isn't NULL for
+            source, output_field = Value(1), IntegerField()
+        case = Case(output_field=output_field, where=self.where_class)
+        case.values = [(self.condition, source)]
+        case.optimized = True
+        aggregate.set_source_expressions([case])
+        return compiler.compile(aggregate)
+
+
+class ColumnCase(ExpressionNode):
+    """
+    A simple CASE expression on a column, with the conditions and results
+    stored as two parallel lists instead of (condition, value) pairs:
+
+        CASE t.id
+            WHEN 1
+                THEN 'a'
+            WHEN 2
+                THEN 'b'
+        END
+
+    Rows that share a value are collapsed into a searched CASE expression
+    with one IN list per value, or into just the value when all of them
+    share it:
+
+        CASE
+            WHEN t.id IN (1, 3)
+                THEN 'a'
+            WHEN t.id IN (2)
+                THEN 'b'
+        END
+
+    Plain keys and values are prepared for the database when compiling, so
+    no expressions need to be created for them. Values and the default can
+    also be resolved expressions.
+    """
+    def __init__(self, col, keys, values, key_field, output_field, default=None):
+        super(ColumnCase, self).__init__(output_field=output_field)
+        self.col = col
+        self.keys = keys
+        self.values = values
+        self.key_field = key_field
+        self.default = default
+
+    def get_source_expressions(self):
+        source_expressions = [self.col]
+        source_expressions.extend(value for value in self.values if hasattr(value, 'as_sql'))
+        if self.default is not None:
+            source_expressions.append(self.default)
+        return source_expressions
+
+    def set_source_expressions(self, exprs):
+        if self.default is not None:
+            self.default = exprs[-1]
+            exprs = exprs[:-1]
+        self.col = exprs[0]
+        exprs = iter(exprs[1:])
+        self.values = [next(exprs) if hasattr(value, 'as_sql') else value for value in self.values]
+
+    def prepare(self, connection):
+        """
+        Returns the keys and the values prepared for the database. Values
+        that are expressions are returned as they are.
+        """
+        prep_key = self.key_field.get_db_prep_value
+        prep_value = self.output_field.get_db_prep_save
+        keys = [prep_key(key, connection) for key in self.keys]
+        values = [value if hasattr(value, 'as_sql') else prep_value(value, connection)
+                  for value in self.values]
+        return keys, values
+
+    @staticmethod
+    def group_keys(keys, values):
+        """
+        Returns a list of (value, keys) pairs in the order the values first
+        appear, or None when no two keys share a value (or the values can't
+        be compared). Of a repeated key only the first value is kept, which
+        is the one a CASE on the key gives.
+        """
+        groups = OrderedDict()
+        seen = set()
+        try:
+            for key, value in zip(keys, values):
+                if key not in seen:
+                    seen.add(key)
+                    groups.setdefault(value, []).append(key)
+        except TypeError:
+            # unhashable values
+            return None
+        if len(groups) == len(seen):
+            return None
+        return list(groups.items())
+
+    def value_sql(self, value, compiler):
+        if hasattr(value, 'as_sql'):
+            return compiler.compile(value)
+        return '%s', [value]
+
+    def as_sql(self, compiler, connection):
+        if not self.keys:
+            if self.default is not None:
+                return compiler.compile(self.default)
+            return 'NULL', ()
+        keys, values = self.prepare(connection)
+        groups = self.group_keys(keys, values)
+        col_sql, col_params = compiler.compile(self.col)
+        if groups is None:
+            result = ['CASE', col_sql]
+            result_params = list(col_params)
+            for key, value in zip(keys, values):
+                value_sql, value_params = self.value_sql(value, compiler)
+                result.append('WHEN %%s THEN %s' % value_sql)
+                result_params.append(key)
+                result_params.extend(value_params)
+        elif len(groups) == 1 and self.default is None:
+            # every row is set to the same value
+            sql, params = self.value_sql(groups[0][0], compiler)
+            return self.cast_sql(sql, connection), params
+        else:
+            result = ['CASE']
+            result_params = []
+            for value, group in groups:
+                value_sql, value_params = self.value_sql(value, compiler)
+                result.append('WHEN %s IN (%s) THEN %s' % (
+                    col_sql, ', '.join(['%s'] * len(group)), value_sql))
+                result_params.extend(col_params)
+                result_params.extend(group)
+                result_params.extend(value_params)
+        if self.default is not None:
+            default_sql, default_params = compiler.compile(self.default)
+            result.append('ELSE %s' % default_sql)
+            result_params.extend(default_params)
+        result.append('END')
+        return self.cast_sql(' '.join(result), connection), result_params
+
+    def cast_sql(self, sql, connection):
+        # cast the whole case expression if required
+        output_field = self.output_field
+        return connection.ops.field_cast_sql(
+            output_field.db_type(connection), output_field.get_internal_type()) % sql
+
 
 class UpdateModelList(ExpressionNode):
     """
     An expression representing multiple instances' values. Resolves to a
-    SimpleCase expression.
+    ColumnCase expression on the primary key, which evaluates to the default
+    for rows of other instances.
     """
-    def __init__(self, objects, output_field=None):
+    def __init__(self, objects, output_field=None, default=None):
         super(UpdateModelList, self).__init__(output_field=output_field)
         self.objects = objects or []
+        if default is not None and not hasattr(default, 'resolve_expression'):
+            # everything must be resolvable to an expression
+            default = Value(default)
+        self.default = default
 
     def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False):
-        c = SimpleCase('pk', output_field=self.output_field)
-        c = c.resolve_expression(query, allow_joins, reuse, summarize)
+        pk_field = query.get_meta().pk
+        col = F(pk_field.name).resolve_expression(query, allow_joins, reuse, summarize)
 
-        # bypass resolving all these values, since it slows down the query
-        # generation by a factor of two
-        def create_resolved_case_tuple(obj, attname=self._output_field.attname):
+        # only expressions need resolving, plain values are kept as they are
+        # and prepared for the database by ColumnCase.as_sql
+        attname = self._output_field.attname
+        keys = []
+        values = []
+        for obj in self.objects:
             value = getattr(obj, attname)
             if hasattr(value, 'resolve_expression'):
-                return Value(obj.pk), value.resolve_expression(query, allow_joins, reuse, summarize)
-            else:
-                return Value(obj.pk), Value(value)
-
-        c.values = list(map(create_resolved_case_tuple, self.objects))
-        return c
+                value = value.resolve_expression(query, allow_joins, reuse, summarize)
+            # the pk of a parent table's row is the instance's link to it
+            keys.append(obj.pk)
+            values.append(value)
+        default = self.default
+        if default is not None:
+            default = default.resolve_expression(query, allow_joins, reuse, summarize)
+        return ColumnCase(col, keys, values, pk_field, self._output_field, default)
@@ -0,0 +1,156 @@
+from __future__ import unicode_literals
+
+from django.db.migrations.operations.base import Operation
+from django.db.migrations.state import ModelState
+from django.db.models.sql.query import Query
+from .expressions import expression_key, materialize
+
+
+def expression_sql(model, expression, schema_editor):
+    """
+    Returns the SQL of an expression over the columns of the model's table
+    for use in DDL: without the table name and with the parameters inlined.
+    Also returns the expression's output field.
+    """
+    connection = schema_editor.connection
+    query = Query(model)
+    query.get_initial_alias()
+    # e.g. SimpleCase lookups would join their lists
+    resolved = expression.resolve_expression(query, allow_joins=False)
+    if len(query.tables) > 1 or resolved.contains_aggregate:
+        raise ValueError("The expression can only refer to the model's own fields.")
+    sql, params = query.get_compiler(connection=connection).compile(resolved)
+    sql = sql.replace('%s.' % schema_editor.quote_name(model._meta.db_table), '')
+    return sql % tuple(schema_editor.quote_value(p) for p in params), resolved.output_field
+
+
+class GeneratedColumnsModelState(ModelState):
+    """
+    The state of a model with generated columns (see AddGeneratedColumn),
+    whose expressions are materialized in the rendered model.
+    """
+    def __init__(self, *args, **kwargs):
+        self.generated_columns = kwargs.pop('generated_columns', {})
+        super(GeneratedColumnsModelState, self).__init__(*args, **kwargs)
+
+    def clone(self):
+        clone = super(GeneratedColumnsModelState, self).clone()
+        clone.generated_columns = dict(self.generated_columns)
+        return clone
+
+    def render(self, apps):
+        model = super(GeneratedColumnsModelState, self).render(apps)
+        for name, expression in self.generated_columns.items():
+            materialize(model, name, expression)
+        return model
+
+
+def add_generated_column(state, app_label, model_name, name, expression):
+    """
+    Adds a generated column to the state of a model.
+    """
+    model_state = state.models[app_label, model_name.lower()]
+    generated_columns = dict(getattr(model_state, 'generated_columns', {}))
+    generated_columns[name] = expression
+    state.models[app_label, model_name.lower()] = GeneratedColumnsModelState(
+        model_state.app_label, model_state.name, list(model_state.fields),
+        dict(model_state.options), model_state.bases, list(model_state.managers),
+        generated_columns=generated_columns)
+    state.reload_model(app_label, model_name.lower())
+
+
+class AddGeneratedColumn(Operation):
+    """
+    Adds a column computed by the database from a Case or SimpleCase
+    expression to the model's table, with an index unless db_index is False.
+    The column is stored on PostgreSQL 12+ and MySQL 5.7+, and virtual on
+    SQLite 3.31+, which can't add stored columns to a table.
+
+    The column isn't a field of the model. Models rendered from the migration
+    state read it instead of computing the expression. For the model itself,
+    record the same expression with materialize().
+    """
+    reduces_to_sql = True
+    reversible = True
+
+    def __init__(self, model_name, name, expression, db_index=True):
+        self.model_name = model_name
+        self.name = name
+        self.expression = expression
+        self.db_index = db_index
+
+    def state_forwards(self, app_label, state):
+        if expression_key(self.expression) is not None:
+            add_generated_column(state, app_label, self.model_name, self.name, self.expression)
+
+    def index_name(self, model, schema_editor):
+        return schema_editor._create_index_name(model, [self.name], suffix='_generated')
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        # the model of to_state would read the column that is being added
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allowed_to_migrate(schema_editor.connection.alias, model):
+            return
+        qn = schema_editor.quote_name
+        table = model._meta.db_table
+        sql, output_field = expression_sql(model, self.expression, schema_editor)
+        schema_editor.execute('ALTER TABLE %s ADD COLUMN %s %s GENERATED ALWAYS AS (%s) %s' % (
+            qn(table), qn(self.name), output_field.db_type(schema_editor.connection), sql,
+            'VIRTUAL' if schema_editor.connection.vendor == 'sqlite' else 'STORED'))
+        if self.db_index:
+            schema_editor.execute(schema_editor.sql_create_index % {
+                'name': qn(self.index_name(model, schema_editor)), 'table': qn(table),
+                'columns': qn(self.name), 'extra': ''})
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allowed_to_migrate(schema_editor.connection.alias, model):
+            return
+        qn = schema_editor.quote_name
+        table = model._meta.db_table
+        if self.db_index:
+            schema_editor.execute(schema_editor.sql_delete_index % {
+                'name': qn(self.index_name(model, schema_editor)), 'table': qn(table)})
+        schema_editor.execute('ALTER TABLE %s DROP COLUMN %s' % (qn(table), qn(self.name)))
+
+    def describe(self):
+        return "Add generated column %s to %s" % (self.name, self.model_name)
+
+
+class AddExpressionIndex(Operation):
+    """
+    Adds an index on a Case or SimpleCase expression to the model's table.
+    The database uses it for queries that filter or order by the identical
+    expression. Requires PostgreSQL, SQLite 3.9+ or MySQL 8.0.13+.
+    """
+    reduces_to_sql = True
+    reversible = True
+
+    def __init__(self, model_name, name, expression):
+        self.model_name = model_name
+        self.name = name
+        self.expression = expression
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allowed_to_migrate(schema_editor.connection.alias, model):
+            return
+        sql, output_field = expression_sql(model, self.expression, schema_editor)
+        schema_editor.execute(schema_editor.sql_create_index % {
+            'name': schema_editor.quote_name(self.name),
+            'table': schema_editor.quote_name(model._meta.db_table),
+            'columns': '(%s)' % sql, 'extra': ''})
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allowed_to_migrate(schema_editor.connection.alias, model):
+            return
+        schema_editor.execute(schema_editor.sql_delete_index % {
+            'name': schema_editor.quote_name(self.name),
+            'table': schema_editor.quote_name(model._meta.db_table)})
+
+    def describe(self):
+        return "Add index %s on an expression to %s" % (self.name, self.model_name)
@@ -1,10 +1,206 @@
 from __future__ import unicode_literals
 
-from django.db import connections, models, transaction
-from django.db.models import sql
+import sys
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from functools import reduce
+from itertools import count, islice
+from operator import attrgetter, itemgetter, or_
+from timeit import default_timer
+
+from django.db import DatabaseError, connections, models, transaction
+from django.db.models.fields import AutoField
 from django.db.models.query_utils import Q
-from django.db.models.sql.constants import CURSOR
-from .expressions import UpdateModelList
+from django.db.transaction import TransactionManagementError
+from django.utils import six
+from django.utils.functional import partition
+from django.utils.six.moves import range
+from .batching import AdaptiveBatchSize
+from .signals import bulk_update_batch
+from .strategies import (
+    BaseUpdateStrategy, StagingUpdateStrategy, get_update_strategy, get_upsert_sql,
+    supports_returning, supports_upsert)
+
+
+WorkerStats = namedtuple('WorkerStats', ['first_pk', 'last_pk', 'objects', 'rows', 'seconds'])
+
+
+class BulkUpdateResult(int):
+    """
+    The number of rows matched by a bulk update, with the statistics of each
+    worker of a parallel bulk update and the instances that weren't updated
+    because their version was stale.
+    """
+    def __new__(cls, rows, workers=(), stale=()):
+        result = super(BulkUpdateResult, cls).__new__(cls, rows)
+        result.workers = list(workers)
+        result.stale = list(stale)
+        return result
+
+
+def is_retryable_error(error):
+    """
+    Returns whether a database error is a deadlock, serialization failure or
+    busy database that a retry of the transaction can get past.
+    """
+    cause = getattr(error, '__cause__', None) or error
+    # SQLSTATEs serialization_failure and deadlock_detected
+    if getattr(cause, 'pgcode', None) in ('40001', '40P01'):
+        return True
+    # MySQL's ER_LOCK_DEADLOCK
+    if getattr(cause, 'args', None) and cause.args[0] == 1213:
+        return True
+    return 'database is locked' in six.text_type(error)
+
+
+class BatchStats(object):
+    """
+    The statistics of the statements that update one batch, which are sent
+    with the bulk_update_batch signal once the batch is done.
+    """
+    def __init__(self):
+        self.statements = 0
+        self.params = 0
+        self.sql_length = 0
+        self.build_time = 0
+        self.execute_time = 0
+
+    def add(self, params, sql, build_time, execute_time):
+        self.statements += 1
+        self.params += len(params)
+        self.sql_length += len(sql.encode('utf-8'))
+        self.build_time += build_time
+        self.execute_time += execute_time
+
+    def send(self, model, using, batch, objects, rows):
+        if self.statements and bulk_update_batch.has_listeners(model):
+            bulk_update_batch.send(
+                sender=model, using=using, batch=batch, objects=objects, rows=rows,
+                params=self.params, sql_length=self.sql_length,
+                build_time=self.build_time, execute_time=self.execute_time)
+
+
+def unique_by(objs, fields):
+    """
+    Returns the objects with distinct values of the fields, keeping the last
+    of each, since later objects overwrite earlier ones when saved in order.
+    """
+    unique = OrderedDict()
+    for obj in objs:
+        key = tuple(getattr(obj, f.attname) for f in fields)
+        unique.pop(key, None)
+        unique[key] = obj
+    return list(unique.values())
+
+
+def changes_of(changed, objs):
+    """
+    Returns the part of a dict of the objects whose value of each field
+    changed (see _get_changes()) that is about the given objects.
+    """
+    if changed is None:
+        return None
+    ids = set(id(o) for o in objs)
+    return dict((attname, [o for o in field_objs if id(o) in ids])
+                for attname, field_objs in changed.items())
+
+
+def values_row_class(model, fields):
+    """
+    Returns a light-weight class for rows of a pk and values of the fields,
+    with the attributes update strategies read from model instances.
+    """
+    base = namedtuple(str('%sValues' % model.__name__),
+                      [model._meta.pk.attname] + [f.attname for f in fields])
+    return type(base.__name__, (base,), {str('__slots__'): (), str('pk'): property(itemgetter(0))})
+
+
+def check_values_row(row, fields):
+    """
+    Returns a row of a pk and values of the fields, or raises a ValueError
+    if it has the wrong number of values.
+    """
+    if len(row) != len(fields) + 1:
+        raise ValueError("Expected rows of a pk and %d values (%s), got %r" % (
+            len(fields), ', '.join(f.name for f in fields), row))
+    return row
+
+
+def set_returned_values(objs, fields, rows, convert=True):
+    """
+    Sets the fields of the objects from rows of (pk, value, ...) values.
+    Values read straight from a cursor are converted with to_python().
+    """
+    pk_field = objs[0]._meta.pk
+    objs_by_pk = {}
+    for obj in objs:
+        objs_by_pk.setdefault(pk_field.to_python(obj.pk), []).append(obj)
+    for row in rows:
+        for obj in objs_by_pk.get(pk_field.to_python(row[0]), ()):
+            for f, value in zip(fields, row[1:]):
+                setattr(obj, f.attname, f.to_python(value) if convert else value)
+
+
+class ParentInstance(object):
+    """
+    An instance of a model with multi-table inheritance, as seen by the
+    update of one of its parents' tables: its pk is the value of the link to
+    the parent, and all other attributes are the instance's.
+    """
+    def __init__(self, obj, link_attname):
+        self.__dict__.update(obj=obj, link_attname=link_attname)
+
+    @property
+    def pk(self):
+        return getattr(self.obj, self.link_attname)
+
+    def __getattr__(self, name):
+        return getattr(self.obj, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.obj, name, value)
+
+
+def take_snapshot(obj):
+    """
+    Remembers the current values of the instance's concrete fields, which
+    bulk_update(only_changed=True) compares against. Deferred fields aren't
+    loaded and are always considered changed once set.
+    """
+    obj._bulk_update_snapshot = {
+        f.attname: obj.__dict__[f.attname]
+        for f in obj._meta.concrete_fields if f.attname in obj.__dict__}
+
+
+def save_instances(objs):
+    """
+    Returns copies of the instances' attributes, for restore_instances().
+    """
+    return [(obj, obj.__dict__.copy()) for obj in objs]
+
+
+def restore_instances(saved):
+    """
+    Puts back the attributes saved by save_instances(), e.g. the versions,
+    returned values and snapshots of an update that was rolled back.
+    """
+    for obj, attrs in saved:
+        obj.__dict__.clear()
+        obj.__dict__.update(attrs)
+
+
+def has_changed(obj, field):
+    """
+    Returns whether the instance's value of the field differs from its
+    snapshot. Instances without a snapshot and expressions always count as
+    changed.
+    """
+    snapshot = getattr(obj, '_bulk_update_snapshot', None)
+    if snapshot is None or field.attname not in snapshot:
+        return True
+    value = getattr(obj, field.attname)
+    return hasattr(value, 'resolve_expression') or value != snapshot[field.attname]
 
 
 class BulkUpdateQuerySet(models.QuerySet):
@@ -12,65 +208,654 @@ class BulkUpdateQuerySet(models.QuerySet):
     A QuerySet that adds methods for bulk updating model instances.
     Heavily based on models.QuerySet.bulk_create and it's helper methods.
     """
-    def bulk_update(self, objs, update_fields=None, batch_size=None):
+    # the number of objects bulk_batch_size() is asked about when the objects
+    # are given as an iterator, whose length isn't known
+    iterator_batch_size = 1000
+    # retries of a batch that failed with a deadlock or serialization
+    # failure, waiting retry_delay seconds (doubled every time) in between
+    batch_retries = 3
+    retry_delay = 0.1
+
+    # the number of objects from which bulk_update uses the 'staging'
+    # strategy when none is given, or None to never use it by default
+    staging_threshold = 100000
+
+    def __init__(self, *args, **kwargs):
+        super(BulkUpdateQuerySet, self).__init__(*args, **kwargs)
+        self._track_changes = False
+
+    def _clone(self, *args, **kwargs):
+        c = super(BulkUpdateQuerySet, self)._clone(*args, **kwargs)
+        c._track_changes = self._track_changes
+        return c
+
+    def iterator(self):
+        for obj in super(BulkUpdateQuerySet, self).iterator():
+            if self._track_changes:
+                take_snapshot(obj)
+            yield obj
+
+    def track_changes(self):
+        """
+        Returns a new QuerySet that takes a snapshot of each instance's
+        values when it is loaded, for bulk_update(only_changed=True).
+        """
+        c = self._clone()
+        c._track_changes = True
+        return c
+
+    def bulk_update(self, objs, update_fields=None, batch_size=None, strategy=None,
+                    only_changed=False, batch_time=None, workers=None, transaction_scope='worker',
+                    returning=None, version_field=None, completed_batches=None):
         """
         Updates each of the instances in the database. This does *not* call
         save() on each of the instances, and does not send any pre/post save
         signals.
+
+        The objects can be given as any iterable, including generators and
+        QuerySet.iterator(). They are pulled, checked and updated one batch at
+        a time, so only a single batch is held in memory. Returns the number
+        of rows matched. The bulk_update_batch signal is sent after each
+        batch with its statistics.
+
+        Instances of a model with multi-table inheritance are updated with
+        one query per table that has fields to update, each keyed on the
+        instance's link to that parent. returning and version_field aren't
+        supported for them.
+
+        The strategy is the name of an update strategy ('case', 'unnest' or
+        'staging') or a BaseUpdateStrategy subclass. It defaults to 'unnest'
+        on PostgreSQL and 'case' on other backends, or to 'staging' for at
+        least staging_threshold objects (given as a sequence) on PostgreSQL,
+        MySQL and SQLite.
+
+        With only_changed the instances' values are compared against the
+        snapshot taken when they were loaded from a track_changes() QuerySet
+        (or by take_snapshot()). Fields that didn't change for any instance
+        in a batch aren't updated, unchanged rows are left out of the query
+        and a batch without any changes isn't sent at all. The snapshots are
+        updated after each batch, and put back if its transaction is rolled
+        back.
+
+        With batch_time (in seconds) the batch size is adaptive: it is kept
+        below the most objects a statement can hold within the backend's
+        parameter and statement length limits (and batch_size, if given),
+        and within that tuned after every batch towards batches that take
+        about batch_time seconds.
+
+        The whole update runs in one transaction, unless transaction_scope is
+        'batch': then each batch is sorted by pk, so concurrent updates lock
+        rows in the same order, and committed on its own. A batch that fails
+        with a deadlock or serialization failure is retried (batch_retries
+        times, with exponential backoff) unless the update runs inside an
+        outer transaction. The index of each committed batch is added to the
+        completed_batches set, if given, and batches already in it are
+        skipped, so an interrupted update can be resumed by passing the same
+        objects, batch_size and set again.
+
+        With workers the objects are sorted by pk and split into that many
+        disjoint pk ranges, which are updated in parallel threads, each with
+        its own database connection. Since every worker locks rows in pk order
+        within its own range, workers can't deadlock each other. There is no
+        transaction around the whole update: each worker runs in its own
+        transaction, or each batch if transaction_scope is 'batch', so workers
+        can't be used inside a transaction. Returns a BulkUpdateResult with
+        the statistics of each worker.
+
+        With returning (a list of field names) the values of those fields are
+        read back into the instances after each batch, e.g. to replace
+        expressions like F('counter') + 1 with the value they gave. PostgreSQL
+        and SQLite 3.35+ return them from the UPDATE itself, other backends
+        select them after each batch.
+
+        With version_field (the name of an integer field) a row is only
+        updated if its value of the field still equals the instance's, and
+        the field is incremented in the same statement. The instances that
+        failed the check are left as they are and listed in the result's
+        stale attribute; the others get the new version, unless the update
+        is rolled back. They are found with
+        RETURNING where the backend supports it. Other backends lock the rows
+        and select their versions before each batch, and compare the number
+        of rows matched after it.
+
+        Returns a BulkUpdateResult.
+        """
+        assert batch_size is None or batch_size > 0
+        assert transaction_scope in ('worker', 'batch')
+        if self.model._meta.parents and (returning or version_field is not None):
+            raise ValueError("Can't bulk update an inherited model with returning or version_field")
+        if completed_batches is not None and (
+                workers or batch_time is not None or transaction_scope != 'batch'):
+            raise ValueError("completed_batches requires transaction_scope='batch', "
+                             "without workers or batch_time")
+        self._for_write = True
+        non_pk_fields = self._get_update_fields(update_fields)
+        if returning:
+            returning = [self.model._meta.get_field(name) for name in returning]
+        stale = []
+        if version_field is not None:
+            version_field = self.model._meta.get_field(version_field)
+            # the version is incremented, not set from the instances
+            non_pk_fields = [f for f in non_pk_fields if f != version_field]
+        # versioned updates can't use the staging table
+        if (strategy is None and self.staging_threshold is not None and
+                version_field is None and hasattr(objs, '__len__') and
+                len(objs) >= self.staging_threshold and
+                connections[self.db].vendor in StagingUpdateStrategy.vendors):
+            strategy = 'staging'
+        kwargs = {'only_changed': only_changed, 'batch_time': batch_time, 'returning': returning,
+                  'version_field': version_field, 'stale': stale}
+        if workers:
+            return self._parallel_update(objs, non_pk_fields, batch_size, strategy, workers,
+                                         transaction_scope, **kwargs)
+        if transaction_scope == 'batch':
+            rows = self._batched_update(objs, non_pk_fields, batch_size, strategy,
+                                        atomic_batches=True, completed_batches=completed_batches,
+                                        **kwargs)
+        else:
+            with transaction.atomic(using=self.db, savepoint=False):
+                rows = self._batched_update(objs, non_pk_fields, batch_size, strategy, **kwargs)
+        return BulkUpdateResult(rows, stale=stale)
+
+    def _get_update_fields(self, update_fields=None):
+        """
+        Returns the concrete non-pk fields to update, including those of
+        multi-table inheritance parents, limited to the names or attnames in
+        update_fields if it's given.
+        """
+        fields = [f for f in self.model._meta.concrete_fields
+                  if not f.primary_key and not getattr(f.rel, 'parent_link', False)]
+        if update_fields:
+            fields = [f for f in fields if f.name in update_fields or f.attname in update_fields]
+        return fields
+
+    def bulk_update_values(self, rows, fields, batch_size=None, strategy=None, batch_time=None):
+        """
+        Updates the fields of rows given as plain values instead of model
+        instances: either a dict of {pk: {field: value}} or an iterable of
+        (pk, value, ...) tuples with a value for each of the fields, in
+        order. Tuples of another length raise a ValueError, before anything
+        is updated if the rows are a sequence. The values are prepared with
+        each field's get_db_prep_save() like instances' values are, and
+        batched the same way as bulk_update. Returns a BulkUpdateResult.
         """
         assert batch_size is None or batch_size > 0
         if self.model._meta.parents:
             raise ValueError("Can't bulk update an inherited model")
-        if not objs:
-            return objs
-        if any(o.pk is None for o in objs):
-            raise ValueError("Can't bulk update instances without a pk")
         self._for_write = True
-        non_pk_fields = [f for f in self.model._meta.local_concrete_fields if not f.primary_key]
-        if update_fields:
+        fields = [self.model._meta.get_field(name) for name in fields]
+        if any(f.primary_key for f in fields):
+            raise ValueError("Can't bulk update the primary key")
+        row_class = values_row_class(self.model, fields)
+        if isinstance(rows, dict):
+            rows = self._iter_values_dict(rows, fields)
+        elif hasattr(rows, '__len__'):
+            for row in rows:
+                check_values_row(row, fields)
+        else:
+            rows = (check_values_row(row, fields) for row in rows)
+        objs = (row_class._make(row) for row in rows)
+        with transaction.atomic(using=self.db, savepoint=False):
+            return BulkUpdateResult(self._batched_update(
+                objs, fields, batch_size, strategy, batch_time=batch_time))
+
+    def _iter_values_dict(self, rows, fields):
+        for pk, values in six.iteritems(rows):
+            try:
+                yield (pk,) + tuple(values[f.name] if f.name in values else values[f.attname]
+                                    for f in fields)
+            except KeyError as e:
+                raise ValueError("No value for the field '%s' of the row with pk %r" % (e.args[0], pk))
+
+    def bulk_upsert(self, objs, conflict_fields, update_fields=None, batch_size=None):
+        """
+        Inserts each of the instances, or updates update_fields (by default
+        all the other fields, except auto_now_add ones) of the row that
+        already has the same values of conflict_fields, which must be unique
+        together. Like bulk_create, it
+        doesn't set the pk of inserted instances with an auto field, and
+        doesn't send any signals.
+
+        On PostgreSQL, SQLite and MySQL each batch is a single INSERT ... ON
+        CONFLICT (or ON DUPLICATE KEY) statement. Other backends select each
+        batch's existing rows first and then use bulk_update and bulk_create.
+        Of instances with the same values of conflict_fields only the last
+        one is saved. Returns the number of rows the database reports as written
+        (MySQL counts an updated row twice).
+        """
+        assert batch_size is None or batch_size > 0
+        if self.model._meta.parents:
+            raise ValueError("Can't bulk upsert an inherited model")
+        if not conflict_fields:
+            raise ValueError("bulk_upsert() needs the names of unique fields to match rows on")
+        self._for_write = True
+        opts = self.model._meta
+        conflict_fields = [opts.get_field(name) for name in conflict_fields]
+        non_pk_fields = [f for f in opts.local_concrete_fields
+                         if not f.primary_key and f not in conflict_fields]
+        if update_fields is not None:
             non_pk_fields = [f for f in non_pk_fields
                              if f.name in update_fields or f.attname in update_fields]
+        else:
+            # keep the time existing rows were created at
+            non_pk_fields = [f for f in non_pk_fields if not getattr(f, 'auto_now_add', False)]
+        connection = connections[self.db]
         with transaction.atomic(using=self.db, savepoint=False):
-            self._batched_update(objs, non_pk_fields, batch_size)
+            if not supports_upsert(connection):
+                return self._select_and_upsert(objs, conflict_fields, non_pk_fields, batch_size)
+            if not batch_size:
+                sized_objs = objs if hasattr(objs, '__len__') else range(self.iterator_batch_size)
+                batch_size = max(connection.ops.bulk_batch_size(opts.local_concrete_fields, sized_objs), 1)
+            rows = 0
+            objs = iter(objs)
+            while True:
+                batch = unique_by(islice(objs, batch_size), conflict_fields)
+                if not batch:
+                    return rows
+                objs_without_pk, objs_with_pk = partition(lambda o: o.pk is not None, batch)
+                for group in (objs_with_pk, objs_without_pk):
+                    if not group:
+                        continue
+                    fields = opts.local_concrete_fields
+                    if group is objs_without_pk:
+                        fields = [f for f in fields if not isinstance(f, AutoField)]
+                    sql, params = get_upsert_sql(self.model, group, fields, conflict_fields,
+                                                 non_pk_fields, connection)
+                    with connection.cursor() as cursor:
+                        cursor.execute(sql, params)
+                        rows += cursor.rowcount
+
+    def _select_and_upsert(self, objs, conflict_fields, fields, batch_size):
+        """
+        Upserts the objects without native support, one batch at a time:
+        selects the pks of the batch's rows that already exist, then updates
+        those and creates the others. Returns the number of objects saved.
+        """
+        names = [f.name for f in conflict_fields]
+        chunk_size = batch_size or self.iterator_batch_size
+        saved = 0
+        objs = iter(objs)
+        while True:
+            batch = unique_by(islice(objs, chunk_size), conflict_fields)
+            if not batch:
+                return saved
+            keys = [tuple(getattr(o, f.attname) for f in conflict_fields) for o in batch]
+            if len(names) == 1:
+                qs = self.filter(**{'%s__in' % names[0]: [key[0] for key in keys]})
+            else:
+                qs = self.filter(reduce(or_, (Q(**dict(zip(names, key))) for key in keys)))
+            existing = dict((tuple(row[:-1]), row[-1]) for row in qs.values_list(*(names + ['pk'])))
+            objs_to_update = []
+            objs_to_create = []
+            for obj, key in zip(batch, keys):
+                if key in existing:
+                    obj.pk = existing[key]
+                    objs_to_update.append(obj)
+                else:
+                    objs_to_create.append(obj)
+            if objs_to_update and fields:
+                self._batched_update(objs_to_update, fields, batch_size)
+            if objs_to_create:
+                self.bulk_create(objs_to_create, batch_size)
+            saved += len(objs_to_update) + len(objs_to_create)
 
-    def _update_many(self, objs, fields, using=None):
+    def _update_many(self, objs, fields, using=None, strategy=None, changed=None, batch=None,
+                     returning=None, version_field=None, stale=None, stats=None, prebuilt=None):
         """
-        Updates many records for the given model. This uses UpdateQuery to
-        generate the query and UpdateValuesList to generate CASE expressions
-        for settings the values.
+        Updates many records for the given model using the given update
+        strategy, which generates and executes the query, and reads the
+        returning fields back into the objects. Objects that fail the version
+        check are added to stale. The statistics of the statements are added
+        to stats, or else sent with the bulk_update_batch signal. prebuilt is
+        the SQL, parameters and build time of the query if it was built
+        ahead of time (see abulk_update). Returns the number of rows matched.
         """
         if using is None:
             using = self.db
-        query = sql.UpdateQuery(self.model)
-        query.add_update_values({f.name: (UpdateModelList(objs, f)) for f in fields})
-        query.add_q(Q(pk__in=(o.pk for o in objs)))
+        connection = connections[using]
+        if not isinstance(strategy, BaseUpdateStrategy):
+            strategy = get_update_strategy(self.model, connection, strategy)
+        limit = strategy.batch_limit(objs, fields, connection, version_field)
+        if limit is not None:
+            # e.g. a staging batch that falls back to CASE expressions
+            batch_stats = BatchStats() if stats is None else stats
+            rows = sum(
+                self._update_many(objs[i:i + limit], fields, using, strategy,
+                                  changes_of(changed, objs[i:i + limit]), batch, returning,
+                                  version_field, stale, batch_stats)
+                for i in range(0, len(objs), limit))
+            if stats is None:
+                batch_stats.send(self.model, using, batch, len(objs), rows)
+            return rows
         self._result_cache = None
-        return query.get_compiler(using=using).execute_sql(CURSOR)
+        start = default_timer()
+        returning_fields = returning
+        if version_field is not None and not supports_returning(connection):
+            objs, changed = self._exclude_stale(objs, changed, version_field, using, stale)
+            if not objs:
+                return 0
+        if version_field is not None:
+            returning_fields = list(returning or [])
+            if version_field not in returning_fields:
+                returning_fields.append(version_field)
+        if prebuilt is None:
+            strategy.prepare(objs, fields, connection, changed, version_field)
+            prepared = default_timer()
+            sql, params = strategy.as_sql(objs, fields, connection, changed, version_field)
+        else:
+            prepared = default_timer()
+            sql, params, build_time = prebuilt
+        returns_rows = bool(returning_fields and sql and supports_returning(connection))
+        if returns_rows:
+            sql += strategy.returning_sql(returning_fields, connection)
+        built = default_timer()
+        if prebuilt is None:
+            build_time = built - prepared
+        if returns_rows:
+            returned = strategy.execute_returning(sql, params, connection)
+            rows = len(returned)
+        else:
+            rows = strategy.execute_sql(sql, params, connection)
+        # the queries before the statement, e.g. selecting versions or loading
+        # a staging table in prepare(), count as executing it
+        statement_stats = BatchStats() if stats is None else stats
+        statement_stats.add(params, sql, build_time, prepared - start + default_timer() - built)
+        if stats is None:
+            statement_stats.send(self.model, using, batch, len(objs), rows)
+        updated = objs
+        if version_field is not None:
+            updated = self._get_updated(objs, version_field, returned if returns_rows else None,
+                                        rows, using)
+            if stale is not None and len(updated) < len(objs):
+                updated_ids = set(id(o) for o in updated)
+                stale.extend(o for o in objs if id(o) not in updated_ids)
+        if not updated:
+            return rows
+        if returns_rows:
+            set_returned_values(updated, returning_fields, returned)
+        elif returning:
+            returned = self.model._base_manager.using(using).filter(
+                pk__in=[o.pk for o in updated]).values_list('pk', *[f.name for f in returning])
+            set_returned_values(updated, returning, returned, convert=False)
+        return rows
     _update_many.alters_data = True
     _update_many.queryset_only = False
 
-    def _batched_update(self, objs, fields, batch_size):
+    def _exclude_stale(self, objs, changed, version_field, using, stale=None):
+        """
+        Locks the objects' rows and leaves out the objects whose version is
+        stale, for backends that can't return the updated rows. Returns the
+        remaining objects and changed objects per field.
+        """
+        attname = version_field.attname
+        versions = dict(self.model._base_manager.using(using).select_for_update().filter(
+            pk__in=[o.pk for o in objs]).values_list('pk', version_field.name))
+        fresh = [o for o in objs if versions.get(o.pk) == getattr(o, attname)]
+        if len(fresh) == len(objs):
+            return objs, changed
+        fresh_ids = set(id(o) for o in fresh)
+        if stale is not None:
+            stale.extend(o for o in objs if id(o) not in fresh_ids)
+        if changed is not None:
+            changed = {name: [o for o in field_objs if id(o) in fresh_ids]
+                       for name, field_objs in changed.items()}
+        return fresh, changed
+
+    def _get_updated(self, objs, version_field, returned, rows, using):
+        """
+        Returns the objects whose rows passed the version check, from the
+        rows returned by the update or else the number of rows matched. The
+        objects' versions are incremented unless they are returned.
+        """
+        pk_field = self.model._meta.pk
+        if returned is not None:
+            pks = set(pk_field.to_python(row[0]) for row in returned)
+            return [o for o in objs if pk_field.to_python(o.pk) in pks]
+        attname = version_field.attname
+        if rows == len(objs):
+            updated = list(objs)
+        else:
+            versions = dict(self.model._base_manager.using(using).filter(
+                pk__in=[o.pk for o in objs]).values_list('pk', version_field.name))
+            updated = [o for o in objs if versions.get(o.pk) == getattr(o, attname) + 1]
+        for obj in updated:
+            setattr(obj, attname, getattr(obj, attname) + 1)
+        return updated
+
+    def _batched_update(self, objs, fields, batch_size, strategy=None, only_changed=False,
+                        batch_time=None, atomic_batches=False, returning=None,
+                        version_field=None, stale=None, completed_batches=None):
         """
         A little helper method for bulk_update to update the bulk one batch
-        at a time in a loop.
+        at a time in a loop. With atomic_batches each batch is sorted by pk
+        and committed (and retried) on its own. Returns the number of rows
+        matched.
+        """
+        connection = connections[self.db]
+        tables = self._get_tables(fields, connection, strategy)
+        # the version adds parameters for every object
+        size_fields = [fields if version_field is None else list(fields) + [version_field]
+                       for strategy, fields, link in tables]
+        adaptive_size = None
+        if batch_time is not None:
+            ceilings = [strategy.max_batch_size(table_size_fields, connection)
+                        for (strategy, fields, link), table_size_fields in zip(tables, size_fields)]
+            ceilings = [ceiling for ceiling in ceilings if ceiling is not None]
+            ceiling = min(ceilings) if ceilings else None
+            if batch_size and (ceiling is None or batch_size < ceiling):
+                ceiling = batch_size
+            adaptive_size = AdaptiveBatchSize(ceiling or float('inf'), batch_time)
+            batch_size = adaptive_size.size
+        elif not batch_size:
+            # the batch size only depends on the number of objects when the
+            # backend has no limits, so don't materialize iterators for it
+            sized_objs = objs if hasattr(objs, '__len__') else range(self.iterator_batch_size)
+            batch_size = max(min(
+                strategy.batch_size(table_size_fields, sized_objs, connection)
+                for (strategy, fields, link), table_size_fields in zip(tables, size_fields)), 1)
+        # batches that don't commit on their own are rolled back together,
+        # so the snapshots, versions and returned values of every batch are
+        # restored on errors
+        saved = None
+        if connection.in_atomic_block and (only_changed or returning or version_field is not None):
+            saved = []
+        rows = 0
+        objs = iter(objs)
+        try:
+            for index in count():
+                batch = list(islice(objs, batch_size))
+                if not batch:
+                    break
+                if any(o.pk is None for o in batch):
+                    raise ValueError("Can't bulk update instances without a pk")
+                if completed_batches is not None and index in completed_batches:
+                    continue
+                if saved is not None:
+                    saved.extend(save_instances(batch))
+                start = default_timer()
+                if atomic_batches:
+                    # rows are locked in pk order, like concurrent bulk updates do
+                    batch.sort(key=attrgetter('pk'))
+                    rows += self._retried_update_batch(batch, tables, only_changed, index,
+                                                       returning, version_field, stale)
+                    if completed_batches is not None:
+                        completed_batches.add(index)
+                else:
+                    rows += self._update_batch(batch, tables, only_changed, index,
+                                               returning, version_field, stale)
+                if adaptive_size is not None:
+                    adaptive_size.record(len(batch), default_timer() - start)
+                    batch_size = adaptive_size.size
+        except BaseException:
+            if saved is not None:
+                restore_instances(saved)
+            # clean up (e.g. drop staging tables, which aren't transactional on
+            # MySQL) without hiding the error if that fails too
+            for strategy, fields, link in tables:
+                try:
+                    strategy.finish(connection)
+                except DatabaseError:
+                    pass
+            raise
+        for strategy, fields, link in tables:
+            strategy.finish(connection)
+        return rows
+
+    def _get_tables(self, fields, connection, strategy=None):
+        """
+        Groups the fields by the table they belong to: the model's own or
+        one of its multi-table inheritance parents'. Returns an update
+        strategy, the fields and the attname of the link to the parent (None
+        for the model's own table) for each table with fields to update.
+        """
+        opts = self.model._meta
+        table_fields = OrderedDict([(opts.concrete_model, [])])
+        for f in fields:
+            table_fields.setdefault(f.model._meta.concrete_model, []).append(f)
+        tables = []
+        for model, model_fields in table_fields.items():
+            if model is opts.concrete_model:
+                if model_fields or not opts.parents:
+                    tables.append((get_update_strategy(self.model, connection, strategy),
+                                   model_fields, None))
+            elif model_fields:
+                tables.append((get_update_strategy(model, connection, strategy), model_fields,
+                               opts.get_ancestor_link(model).attname))
+        return tables
+
+    def _parallel_update(self, objs, fields, batch_size, strategy, workers, transaction_scope,
+                         **kwargs):
         """
+        Updates disjoint pk ranges of the objects in parallel threads. Returns
+        a BulkUpdateResult.
+        """
+        assert transaction_scope in ('worker', 'batch')
+        if connections[self.db].in_atomic_block:
+            # the workers' connections would neither see the transaction's
+            # changes nor be rolled back with it
+            raise TransactionManagementError("Can't bulk update with workers inside a transaction")
+        objs = list(objs)
         if not objs:
-            return
-        ops = connections[self.db].ops
-
-        # re-use DatabaseOperations.bulk_batch_size, by passing a list of
-        # fields (with duplicates) that have placeholders in the query.
-        def iter_placeholder_fields(fields, pk_field):
-            for f in fields:
-                yield pk_field
-                yield f
-            yield pk_field
-
-        placeholder_fields = tuple(iter_placeholder_fields(fields, self.model._meta.pk))
-        batch_size = (batch_size or max(ops.bulk_batch_size(placeholder_fields, objs), 1))
-        for batch in [objs[i:i + batch_size] for i in range(0, len(objs), batch_size)]:
-            self._update_many(batch, fields=fields, using=self.db)
-            # # or without helper method
-            # self.model._base_manager.using(self.db)\
-            #     .filter(pk__in=(o.pk for o in batch))\
-            #     .update(**{f.name: (UpdateModelList(batch, f)) for f in fields})
+            return BulkUpdateResult(0)
+        if any(o.pk is None for o in objs):
+            raise ValueError("Can't bulk update instances without a pk")
+        objs.sort(key=attrgetter('pk'))
+        chunk_size = -(-len(objs) // workers)
+        chunks = [objs[i:i + chunk_size] for i in range(0, len(objs), chunk_size)]
+        results = [None] * len(chunks)
+        errors = []
+
+        def work(index, chunk):
+            start = default_timer()
+            try:
+                if transaction_scope == 'worker':
+                    with transaction.atomic(using=self.db):
+                        rows = self._batched_update(chunk, fields, batch_size, strategy, **kwargs)
+                else:
+                    rows = self._batched_update(chunk, fields, batch_size, strategy,
+                                                atomic_batches=True, **kwargs)
+                results[index] = WorkerStats(
+                    chunk[0].pk, chunk[-1].pk, len(chunk), rows, default_timer() - start)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                # each thread has its own connection
+                connections[self.db].close()
+
+        threads = [threading.Thread(target=work, args=(index, chunk))
+                   for index, chunk in enumerate(chunks)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return BulkUpdateResult(sum(stats.rows for stats in results), results, kwargs.get('stale', ()))
+
+    def _retried_update_batch(self, objs, tables, only_changed=False, index=None,
+                              returning=None, version_field=None, stale=None):
+        """
+        Updates a single batch in its own transaction, retrying it after
+        deadlocks and serialization failures unless it runs inside another
+        transaction. The instances are left as they were if the transaction
+        is rolled back. Returns the number of rows matched.
+        """
+        connection = connections[self.db]
+        # the update sets versions, returned values and snapshots on the
+        # instances before the transaction commits
+        saved = save_instances(objs)
+        for attempt in count():
+            stale_count = len(stale) if stale is not None else 0
+            try:
+                with transaction.atomic(using=self.db):
+                    return self._update_batch(objs, tables, only_changed, index,
+                                              returning, version_field, stale)
+            except Exception as e:
+                restore_instances(saved)
+                if stale is not None:
+                    del stale[stale_count:]
+                # e.g. forget staging tables whose creation was rolled back
+                for strategy, fields, link in tables:
+                    try:
+                        strategy.finish(connection)
+                    except DatabaseError:
+                        pass
+                if (not isinstance(e, DatabaseError) or attempt >= self.batch_retries or
+                        connection.in_atomic_block or not is_retryable_error(e)):
+                    raise
+            time.sleep(self.retry_delay * 2 ** attempt)
+
+    def _update_batch(self, objs, tables, only_changed=False, index=None, returning=None,
+                      version_field=None, stale=None):
+        """
+        Updates a single batch in each of the tables from _get_tables(),
+        leaving out what didn't change if only_changed is set. Returns the
+        number of rows matched in the first table updated.
+        """
+        stats = BatchStats()
+        updates = []
+        for strategy, fields, link in tables:
+            table_objs = objs if link is None else [ParentInstance(o, link) for o in objs]
+            changed = None
+            if only_changed:
+                # compare all tables before the snapshots are updated
+                table_objs, fields, changed = self._get_changes(table_objs, fields)
+                if not table_objs:
+                    continue
+            updates.append((strategy, table_objs, fields, changed))
+        rows = None
+        for strategy, table_objs, fields, changed in updates:
+            table_rows = self._update_many(table_objs, fields=fields, using=self.db,
+                                           strategy=strategy, changed=changed, batch=index,
+                                           returning=returning, version_field=version_field,
+                                           stale=stale, stats=stats)
+            if rows is None:
+                rows = table_rows
+        # one signal for all the tables' statements
+        written = set(id(o.obj if isinstance(o, ParentInstance) else o)
+                      for strategy, table_objs, fields, changed in updates for o in table_objs)
+        stats.send(self.model, self.db, index, len(written), rows or 0)
+        if only_changed and updates:
+            for obj in objs:
+                take_snapshot(obj)
+        return rows or 0
+
+    def _get_changes(self, objs, fields):
+        """
+        Returns the changed objects, the changed fields and a dict of the
+        objects that changed per field attname.
+        """
+        changed = {}
+        for f in fields:
+            field_objs = [o for o in objs if has_changed(o, f)]
+            if field_objs:
+                changed[f.attname] = field_objs
+        changed_ids = set(id(o) for field_objs in changed.values() for o in field_objs)
+        return ([o for o in objs if id(o) in changed_ids],
+                [f for f in fields if f.attname in changed],
+                changed)
+
+
+if sys.version_info >= (3, 5):
+    from .aio import abulk_update
+    BulkUpdateQuerySet.abulk_update = abulk_update
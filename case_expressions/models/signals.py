@@ -0,0 +1,10 @@
+from __future__ import unicode_literals
+
+from django.dispatch import Signal
+
+
+# Sent by BulkUpdateQuerySet.bulk_update after each batch, with the model as
+# the sender. build_time and execute_time are in seconds, sql_length in bytes,
+# summed over the queries of the batch when it updates several tables.
+bulk_update_batch = Signal(providing_args=[
+    'using', 'batch', 'objects', 'rows', 'params', 'sql_length', 'build_time', 'execute_time'])
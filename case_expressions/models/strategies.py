@@ -0,0 +1,623 @@
+from __future__ import unicode_literals
+
+import threading
+from collections import namedtuple, OrderedDict
+from itertools import count
+
+from django.db.models import sql
+from django.db.models.expressions import F
+from django.db.models.fields import AutoField, BooleanField, IntegerField
+from django.db.models.query_utils import Q
+from django.utils import six
+from .batching import estimate_value_length, get_backend_limits
+from .expressions import ColumnCase, UpdateModelList
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+StatementCosts = namedtuple('StatementCosts', [
+    'params', 'length', 'row_params', 'row_length', 'row_fields'])
+
+
+class UpdateSQLCache(object):
+    """
+    A bounded LRU cache of compiled bulk update SQL. Keys describe everything
+    the SQL text depends on, so a hit only needs the parameters to be bound.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                sql = self._cache.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # re-insert to mark as most recently used
+            self._cache[key] = sql
+            self.hits += 1
+            return sql
+
+    def set(self, key, sql):
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = sql
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._cache))
+
+
+update_sql_cache = UpdateSQLCache()
+
+
+def has_expressions(objs, fields):
+    return any(hasattr(getattr(o, f.attname), 'resolve_expression') for f in fields for o in objs)
+
+
+def partial_changes(objs, fields, changed=None):
+    """
+    Returns a dict of the fields that only changed for some of the objects
+    (see BaseUpdateStrategy) to the ids of the objects whose value changed.
+    """
+    if changed is None:
+        return {}
+    return dict((f, set(id(o) for o in changed[f.attname]))
+                for f in fields if len(changed[f.attname]) < len(objs))
+
+
+def changed_column(field):
+    """
+    Returns the name of the column that marks the rows whose value of a
+    partially changed field changed (see partial_changes()).
+    """
+    return '%s__changed' % field.column
+
+
+class BaseUpdateStrategy(object):
+    """
+    Generates and executes the UPDATE statement for one batch of a bulk
+    update. Subclasses only need to implement as_sql().
+
+    The changed argument optionally maps field attnames to the objects whose
+    value of that field changed. Strategies must leave the other objects'
+    values of the field as they are in the database.
+
+    With a version_field, strategies must only update the rows whose value
+    of it still equals the object's, and increment it in the same statement.
+    """
+    # database vendors the strategy supports, or None for all of them
+    vendors = None
+
+    def __init__(self, model):
+        self.model = model
+
+    def batch_size(self, fields, objs, connection):
+        """
+        Returns the maximum number of objects that can be updated in a single
+        statement.
+        """
+        return len(objs)
+
+    def get_statement_costs(self, fields, connection):
+        """
+        Returns a StatementCosts with the number of parameters and the SQL
+        length of a statement without objects, the number of parameters and
+        the SQL length each object adds to it, and the fields whose values
+        each object adds (the parameters or interpolated values).
+        """
+        raise NotImplementedError("Subclasses must implement get_statement_costs()")
+
+    def max_batch_size(self, fields, connection):
+        """
+        Returns the most objects that fit in a single statement within the
+        backend's limits, or None if there is no limit.
+        """
+        limits = get_backend_limits(connection)
+        costs = self.get_statement_costs(fields, connection)
+        row_length = costs.row_length
+        if limits.inlines_params:
+            row_length += sum(estimate_value_length(f) for f in costs.row_fields)
+        sizes = []
+        if limits.max_params and costs.row_params:
+            sizes.append((limits.max_params - costs.params) // costs.row_params)
+        if limits.max_sql_length and row_length:
+            sizes.append((limits.max_sql_length - costs.length) // row_length)
+        if not sizes:
+            return None
+        return max(min(sizes), 1)
+
+    def batch_limit(self, objs, fields, connection, version_field=None):
+        """
+        Returns the most of a batch's objects that a single statement can
+        update, if that depends on the objects and is less than all of them,
+        or None.
+        """
+        return None
+
+    def prepare(self, objs, fields, connection, changed=None, version_field=None):
+        """
+        Called with each batch before as_sql(), e.g. to send the batch's
+        values to the database separately.
+        """
+        pass
+
+    def as_sql(self, objs, fields, connection, changed=None, version_field=None):
+        raise NotImplementedError("Subclasses must implement as_sql()")
+
+    def finish(self, connection):
+        """
+        Called after the last batch of a bulk update, and after a batch whose
+        transaction was rolled back.
+        """
+        pass
+
+    def execute_sql(self, sql, params, connection):
+        """
+        Executes the SQL from as_sql() and returns the number of rows matched.
+        """
+        if not sql:
+            return 0
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    def returning_sql(self, fields, connection):
+        """
+        Returns a RETURNING clause for the SQL from as_sql() with the pk and
+        the fields of the updated rows. The columns are qualified, since the
+        statement may join other tables.
+        """
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        return ' RETURNING %s' % ', '.join(
+            '%s.%s' % (qn(opts.db_table), qn(f.column)) for f in [opts.pk] + list(fields))
+
+    def execute_returning(self, sql, params, connection):
+        """
+        Executes the SQL from as_sql() with a RETURNING clause and returns the
+        returned rows.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+
+class CaseUpdateStrategy(BaseUpdateStrategy):
+    """
+    Sets each field to a CASE expression on the primary key, which works on
+    every backend:
+
+        UPDATE t
+        SET f = CASE t.id WHEN 1 THEN 'a' WHEN 2 THEN 'b' END
+        WHERE t.id IN (1, 2)
+
+    Batches that only contain plain values compile to the same SQL for the
+    same model, fields, number of objects and grouping of equal values (see
+    ColumnCase), so the SQL is kept in update_sql_cache and only the
+    parameters are rebuilt for later batches.
+    """
+    cache = update_sql_cache
+
+    def batch_size(self, fields, objs, connection):
+        # re-use DatabaseOperations.bulk_batch_size, by passing a list of
+        # fields (with duplicates) that have placeholders in the query.
+        pk_field = self.model._meta.pk
+
+        def iter_placeholder_fields(fields, pk_field):
+            for f in fields:
+                yield pk_field
+                yield f
+            yield pk_field
+
+        placeholder_fields = tuple(iter_placeholder_fields(fields, pk_field))
+        return connection.ops.bulk_batch_size(placeholder_fields, objs)
+
+    def get_statement_costs(self, fields, connection):
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        table = qn(opts.db_table)
+        pk_column = '%s.%s' % (table, qn(opts.pk.column))
+        length = len('UPDATE %s SET  WHERE %s IN ()' % (table, pk_column))
+        for f in fields:
+            length += len('%s = CASE %s ELSE %s.%s END, ' % (qn(f.column), pk_column, table, qn(f.column)))
+        # rows either get their own WHEN, or share one with at least one
+        # other row that has the same value
+        when_length = max(len(' WHEN %s THEN %s'),
+                          (len(' WHEN %s IN (%%s, %%s) THEN %%s' % pk_column) + 1) // 2)
+        row_fields = [opts.pk]
+        for f in fields:
+            row_fields.extend([opts.pk, f])
+        return StatementCosts(0, length, len(row_fields),
+                              len(fields) * when_length + len(', %s'), row_fields)
+
+    def get_query(self, objs, fields, changed=None, version_field=None):
+        query = sql.UpdateQuery(self.model)
+        values = []
+        for f in fields:
+            field_objs = objs if changed is None else changed[f.attname]
+            if len(field_objs) < len(objs):
+                # keep the current value of the rows that didn't change
+                values.append((f, self.model, UpdateModelList(field_objs, f, default=F(f.name))))
+            else:
+                values.append((f, self.model, UpdateModelList(objs, f)))
+        if version_field is not None:
+            values.append((version_field, self.model, F(version_field.name) + 1))
+        # add_update_fields keeps the order of the fields, which the cached
+        # SQL relies on
+        query.add_update_fields(values)
+        query.add_q(Q(pk__in=[o.pk for o in objs]))
+        if version_field is not None:
+            # compare each row's version to its instance's, with a CASE on the
+            # pk instead of a condition per row
+            query.add_q(Q(**{version_field.name: UpdateModelList(objs, version_field)}))
+        return query
+
+    def describe(self, objs, fields, connection, changed=None):
+        """
+        Returns a hashable description of the SQL of a batch of plain values
+        and the parameters in the order they appear in the SQL, following
+        ColumnCase.as_sql. Returns None if the batch contains expressions,
+        which are compiled into the SQL text.
+        """
+        pk_field = self.model._meta.pk
+        prep_pk = pk_field.get_db_prep_value
+        shape = []
+        params = []
+        for f in fields:
+            attname, prep_value = f.attname, f.get_db_prep_save
+            field_objs = objs if changed is None else changed[attname]
+            keys, values = [], []
+            for o in field_objs:
+                value = getattr(o, attname)
+                if hasattr(value, 'resolve_expression'):
+                    return None
+                keys.append(prep_pk(o.pk, connection))
+                values.append(prep_value(value, connection))
+            has_default = len(field_objs) < len(objs)
+            groups = ColumnCase.group_keys(keys, values)
+            if groups is None:
+                shape.append((f.attname, len(keys), None, has_default))
+                for key, value in zip(keys, values):
+                    params.append(key)
+                    params.append(value)
+            else:
+                shape.append((f.attname, len(keys), tuple(len(group) for value, group in groups),
+                              has_default))
+                if len(groups) == 1 and not has_default:
+                    params.append(groups[0][0])
+                else:
+                    for value, group in groups:
+                        params.extend(group)
+                        params.append(value)
+        params.extend(pk_field.get_db_prep_lookup('in', [o.pk for o in objs], connection))
+        opts = self.model._meta
+        return (opts.app_label, opts.object_name, len(objs), tuple(shape), connection.vendor), params
+
+    def as_sql(self, objs, fields, connection, changed=None, version_field=None):
+        # versioned updates aren't cached, their WHERE clause differs
+        description = None
+        if version_field is None:
+            description = self.describe(objs, fields, connection, changed)
+        if description is not None:
+            key, cached_params = description
+            sql = self.cache.get(key)
+            if sql is not None:
+                return sql, cached_params
+        query = self.get_query(objs, fields, changed, version_field)
+        sql, params = query.get_compiler(connection=connection).as_sql()
+        # only cache SQL whose parameters can be reproduced without compiling
+        if description is not None and list(params) == cached_params:
+            self.cache.set(key, sql)
+        return sql, params
+
+
+class UnnestUpdateStrategy(BaseUpdateStrategy):
+    """
+    Sends one array per column and joins them to the table with unnest(), so
+    the SQL only depends on the model and the fields being updated:
+
+        UPDATE t
+        SET f = v.f
+        FROM unnest(%s::integer[], %s::text[]) AS v (id, f)
+        WHERE t.id = v.id
+
+    Batches containing expressions (e.g. F('value') + 1) can't be sent as
+    arrays and fall back to the CASE based update. A field that only changed
+    for some of the objects gets a boolean array of which did, and rows that
+    didn't keep their value. A version field is sent as another array, and
+    compared in the join condition.
+    """
+    vendors = ('postgresql',)
+    alias = 'bulk_update_values'
+
+    # serial types are only valid in column definitions
+    array_types = {
+        'serial': 'integer',
+        'bigserial': 'bigint',
+        'smallserial': 'smallint',
+    }
+
+    def get_statement_costs(self, fields, connection):
+        opts = self.model._meta
+        columns = [opts.pk] + list(fields)
+        sql, params = self.as_sql([self.model(pk=0)], fields, connection)
+        # every object adds one value to each array
+        return StatementCosts(len(params), len(sql), 0, len(', ') * len(columns), columns)
+
+    def array_type(self, field, connection):
+        db_type = field.db_type(connection)
+        return '%s[]' % self.array_types.get(db_type, db_type)
+
+    def as_sql(self, objs, fields, connection, changed=None, version_field=None):
+        if has_expressions(objs, fields):
+            return CaseUpdateStrategy(self.model).as_sql(objs, fields, connection, changed,
+                                                         version_field)
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        table, alias, pk_column = qn(opts.db_table), qn(self.alias), qn(opts.pk.column)
+        columns = [opts.pk] + list(fields)
+        partial = partial_changes(objs, fields, changed)
+        assignments = []
+        for f in fields:
+            column = qn(f.column)
+            if f in partial:
+                assignments.append('%s = CASE WHEN %s.%s THEN %s.%s ELSE %s.%s END' % (
+                    column, alias, qn(changed_column(f)), alias, column, table, column))
+            else:
+                assignments.append('%s = %s.%s' % (column, alias, column))
+        where = '%s.%s = %s.%s' % (table, pk_column, alias, pk_column)
+        if version_field is not None:
+            column = qn(version_field.column)
+            columns.append(version_field)
+            assignments.append('%s = %s.%s + 1' % (column, table, column))
+            where += ' AND %s.%s = %s.%s' % (table, column, alias, column)
+        types = [self.array_type(f, connection) for f in columns] + ['boolean[]'] * len(partial)
+        names = [f.column for f in columns] + [changed_column(f) for f in fields if f in partial]
+        sql = 'UPDATE %s SET %s FROM unnest(%s) AS %s (%s) WHERE %s' % (
+            table,
+            ', '.join(assignments),
+            ', '.join('%%s::%s' % array_type for array_type in types),
+            alias,
+            ', '.join(qn(name) for name in names),
+            where)
+        # of objects with the same pk the first one is used, like CASE does
+        rows = OrderedDict()
+        for o in objs:
+            rows.setdefault(opts.pk.get_db_prep_value(o.pk, connection), o)
+        objs = list(rows.values())
+        params = [list(rows)]
+        params.extend([f.get_db_prep_save(getattr(o, f.attname), connection) for o in objs]
+                      for f in columns[1:])
+        params.extend([id(o) in partial[f] for o in objs] for f in fields if f in partial)
+        return sql, params
+
+
+def supports_returning(connection):
+    """
+    Returns whether the backend can return the updated rows from an UPDATE.
+    """
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 35, 0)
+    return False
+
+
+def supports_upsert(connection):
+    """
+    Returns whether the backend can insert or update rows in one statement.
+    """
+    if connection.vendor == 'postgresql':
+        return connection.pg_version >= 90500
+    if connection.vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 24, 0)
+    return connection.vendor == 'mysql'
+
+
+def get_upsert_sql(model, objs, fields, conflict_fields, update_fields, connection):
+    """
+    Returns the SQL and parameters of a statement that inserts the objects'
+    values of the fields, and sets update_fields of the rows that already
+    exist instead (or leaves them alone if there are no update_fields):
+
+        INSERT INTO t (key, f) VALUES (%s, %s), (%s, %s)
+        ON CONFLICT (key) DO UPDATE SET f = EXCLUDED.f
+
+    MySQL has no conflict target, and updates the row that conflicts on any
+    unique key.
+    """
+    qn = connection.ops.quote_name
+    row = '(%s)' % ', '.join(['%s'] * len(fields))
+    sql = 'INSERT INTO %s (%s) VALUES %s' % (
+        qn(model._meta.db_table),
+        ', '.join(qn(f.column) for f in fields),
+        ', '.join([row] * len(objs)))
+    params = [f.get_db_prep_save(f.pre_save(o, True), connection) for o in objs for f in fields]
+    if connection.vendor == 'mysql':
+        # there is no DO NOTHING, so set a conflicting column to itself
+        columns = [qn(f.column) for f in update_fields or conflict_fields[:1]]
+        sql += ' ON DUPLICATE KEY UPDATE %s' % ', '.join(
+            '%s = VALUES(%s)' % (column, column) for column in columns)
+    else:
+        sql += ' ON CONFLICT (%s)' % ', '.join(qn(f.column) for f in conflict_fields)
+        if update_fields:
+            sql += ' DO UPDATE SET %s' % ', '.join(
+                '%s = EXCLUDED.%s' % (qn(f.column), qn(f.column)) for f in update_fields)
+        else:
+            sql += ' DO NOTHING'
+    return sql, params
+
+
+# numbers the staging tables, whose names have to be unique in a session
+_staging_tables = count(1)
+
+
+class StagingUpdateStrategy(BaseUpdateStrategy):
+    """
+    Loads each batch into a temporary table with executemany() and updates
+    the table from it with a single join, which is the fastest way to update
+    very large numbers of rows, in batches of many thousands:
+
+        CREATE TEMPORARY TABLE bulk_update_staging_1 (id integer PRIMARY KEY, f text)
+        INSERT INTO bulk_update_staging_1 (id, f) VALUES (%s, %s)
+        UPDATE t SET f = s.f FROM bulk_update_staging_1 s WHERE t.id = s.id
+
+    The temporary table is emptied between batches and dropped by finish().
+    Batches with expressions or a version field use the CASE based update,
+    split into statements within the backend's limits (see batch_limit()).
+    A field that only changed for some of the objects gets a boolean column
+    of which did, and rows that didn't keep their value.
+    """
+    vendors = ('postgresql', 'mysql', 'sqlite')
+    # the most rows loaded and joined at once
+    chunk_size = 100000
+
+    def __init__(self, model):
+        super(StagingUpdateStrategy, self).__init__(model)
+        self.table = None
+        self.columns = None
+        # whether the current batch is updated with CASE expressions instead
+        self.fallback = True
+
+    def batch_size(self, fields, objs, connection):
+        return min(len(objs), self.chunk_size)
+
+    def get_statement_costs(self, fields, connection):
+        # the values aren't part of the statement
+        return StatementCosts(0, 0, 0, 0, [])
+
+    def batch_limit(self, objs, fields, connection, version_field=None):
+        if not self.needs_fallback(objs, fields, version_field):
+            return None
+        size_fields = fields if version_field is None else list(fields) + [version_field]
+        size = max(CaseUpdateStrategy(self.model).batch_size(size_fields, objs, connection), 1)
+        return size if size < len(objs) else None
+
+    def needs_fallback(self, objs, fields, version_field=None):
+        return version_field is not None or has_expressions(objs, fields)
+
+    def column_type(self, field, connection):
+        if isinstance(field, AutoField):
+            # like a foreign key to the field
+            return IntegerField().db_type(connection)
+        return field.db_type(connection)
+
+    def prepare(self, objs, fields, connection, changed=None, version_field=None):
+        self.fallback = self.needs_fallback(objs, fields, version_field)
+        if self.fallback:
+            return
+        qn = connection.ops.quote_name
+        pk_field = self.model._meta.pk
+        partial = partial_changes(objs, fields, changed)
+        partial_fields = [f for f in fields if f in partial]
+        columns = [(pk_field.column, '%s PRIMARY KEY' % self.column_type(pk_field, connection))]
+        columns.extend((f.column, self.column_type(f, connection)) for f in fields)
+        columns.extend((changed_column(f), BooleanField().db_type(connection))
+                       for f in partial_fields)
+        if self.table is not None and columns != self.columns:
+            # only_changed updates different fields per batch
+            self.finish(connection)
+        # of objects with the same pk the first one is used, like CASE does
+        rows = OrderedDict()
+        for o in objs:
+            pk = pk_field.get_db_prep_value(o.pk, connection)
+            if pk not in rows:
+                rows[pk] = ([pk] + [f.get_db_prep_save(getattr(o, f.attname), connection)
+                                    for f in fields] +
+                            [id(o) in partial[f] for f in partial_fields])
+        with connection.cursor() as cursor:
+            if self.table is None:
+                self.table = 'bulk_update_staging_%d' % next(_staging_tables)
+                self.columns = columns
+                cursor.execute('CREATE TEMPORARY TABLE %s (%s)' % (qn(self.table), ', '.join(
+                    '%s %s' % (qn(name), column_type) for name, column_type in columns)))
+            else:
+                cursor.execute('DELETE FROM %s' % qn(self.table))
+            cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+                qn(self.table),
+                ', '.join(qn(name) for name, column_type in columns),
+                ', '.join(['%s'] * len(columns))), list(rows.values()))
+
+    def as_sql(self, objs, fields, connection, changed=None, version_field=None):
+        if self.fallback:
+            return CaseUpdateStrategy(self.model).as_sql(objs, fields, connection, changed,
+                                                         version_field)
+        qn = connection.ops.quote_name
+        table, staging = qn(self.model._meta.db_table), qn(self.table)
+        pk_column = qn(self.model._meta.pk.column)
+        join = '%s.%s = %s.%s' % (table, pk_column, staging, pk_column)
+        partial = partial_changes(objs, fields, changed)
+        values = []
+        for f in fields:
+            column = qn(f.column)
+            if f in partial:
+                values.append('CASE WHEN %s.%s THEN %s.%s ELSE %s.%s END' % (
+                    staging, qn(changed_column(f)), staging, column, table, column))
+            else:
+                values.append('%s.%s' % (staging, column))
+        if connection.vendor == 'mysql':
+            return 'UPDATE %s INNER JOIN %s ON %s SET %s' % (table, staging, join, ', '.join(
+                '%s.%s = %s' % (table, qn(f.column), value) for f, value in zip(fields, values))), []
+        if connection.vendor == 'sqlite' and not self.supports_update_from(connection):
+            return 'UPDATE %s SET %s WHERE %s IN (SELECT %s FROM %s)' % (table, ', '.join(
+                '%s = (SELECT %s FROM %s WHERE %s)' % (qn(f.column), value, staging, join)
+                for f, value in zip(fields, values)), pk_column, pk_column, staging), []
+        return 'UPDATE %s SET %s FROM %s WHERE %s' % (table, ', '.join(
+            '%s = %s' % (qn(f.column), value) for f, value in zip(fields, values)), staging, join), []
+
+    @staticmethod
+    def supports_update_from(connection):
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 33, 0)
+
+    def finish(self, connection):
+        if self.table is None:
+            return
+        # forget the table even if dropping it fails. It's gone already if
+        # the transaction that created it was rolled back.
+        table, self.table, self.columns = self.table, None, None
+        drop = ('DROP TEMPORARY TABLE IF EXISTS %s' if connection.vendor == 'mysql' else
+                'DROP TABLE IF EXISTS %s')
+        with connection.cursor() as cursor:
+            cursor.execute(drop % connection.ops.quote_name(table))
+
+
+update_strategies = {
+    'case': CaseUpdateStrategy,
+    'unnest': UnnestUpdateStrategy,
+    'staging': StagingUpdateStrategy,
+}
+
+
+def get_update_strategy(model, connection, strategy=None):
+    """
+    Returns an update strategy instance for the model. The strategy can be
+    given as a name from update_strategies or as a BaseUpdateStrategy
+    subclass. By default PostgreSQL uses unnest() and other backends use CASE
+    expressions.
+    """
+    if strategy is None:
+        strategy = 'unnest' if connection.vendor == 'postgresql' else 'case'
+    if isinstance(strategy, six.string_types):
+        try:
+            strategy = update_strategies[strategy]
+        except KeyError:
+            raise ValueError("Unknown bulk update strategy '%s'." % strategy)
+    if strategy.vendors is not None and connection.vendor not in strategy.vendors:
+        raise ValueError("%s isn't supported on %s." % (strategy.__name__, connection.vendor))
+    return strategy(model)
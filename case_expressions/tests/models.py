@@ -13,5 +13,30 @@ class BulkUpdateQuerySetTestModel(models.Model):
     integer = models.IntegerField()
     string = models.CharField(max_length=100)
     boolean = models.BooleanField(default=False)
+    version = models.IntegerField(default=0)
+
+    objects = models.Manager.from_queryset(BulkUpdateQuerySet)()
+
+
+class BulkUpsertTestModel(models.Model):
+    key = models.CharField(max_length=100, unique=True)
+    integer = models.IntegerField()
+    string = models.CharField(max_length=100, default='')
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = models.Manager.from_queryset(BulkUpdateQuerySet)()
+
+
+class BulkUpdateParentTestModel(models.Model):
+    integer = models.IntegerField()
+
+
+class BulkUpdateOtherParentTestModel(models.Model):
+    other_id = models.AutoField(primary_key=True)
+    boolean = models.BooleanField(default=False)
+
+
+class BulkUpdateChildTestModel(BulkUpdateParentTestModel, BulkUpdateOtherParentTestModel):
+    string = models.CharField(max_length=100)
 
     objects = models.Manager.from_queryset(BulkUpdateQuerySet)()
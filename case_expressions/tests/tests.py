@@ -1,16 +1,39 @@
 from __future__ import unicode_literals
 
+import datetime
+import gc
+import time
+import weakref
 from operator import attrgetter
-from unittest import TestCase, skip
+from unittest import TestCase, skipUnless
 
-from django.db import connection, models
+from django.apps import apps
+from django.db import OperationalError, connection, models, transaction
 from django.db.backends.sqlite3.base import DatabaseWrapper
-from django.db.models import F, Q, CharField
+from django.db.models import Count, F, Q, Sum, CharField
+from django.db.migrations.state import ProjectState
 from django.db.models.sql.query import Query
 from django.db.models.sql.compiler import SQLCompiler
-from django.test import TestCase as DjangoTestCase
-from .models import CaseTestModel, BulkUpdateQuerySetTestModel
-from ..models.expressions import Case, SimpleCase, UpdateModelList
+from django.db.transaction import TransactionManagementError
+from django.test import TestCase as DjangoTestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from .models import (
+    CaseTestModel, BulkUpdateChildTestModel, BulkUpdateOtherParentTestModel,
+    BulkUpdateQuerySetTestModel, BulkUpsertTestModel)
+from ..models.batching import AdaptiveBatchSize, get_backend_limits
+from ..models.evaluation import evaluate
+from ..models.signals import bulk_update_batch
+from ..models.expressions import (
+    Case, Filter, SimpleCase, UpdateModelList, dematerialize, expression_key, materialize, q_key)
+from ..models.operations import AddExpressionIndex, AddGeneratedColumn
+from ..models.strategies import (
+    CaseUpdateStrategy, StagingUpdateStrategy, UnnestUpdateStrategy, UpdateSQLCache, get_update_strategy,
+    supports_returning, supports_upsert, update_sql_cache, update_strategies)
+
+
+class NoMigrationsRouter(object):
+    def allow_migrate(self, db, model, **hints):
+        return False
 
 
 class CaseExpressionTestCase(TestCase):
@@ -61,6 +84,36 @@ class CaseUnitTests(CaseExpressionTestCase):
             Case(default="I cannot count", output_field=CharField()),
             '%s', ['I cannot count'])
 
+    def test_conditions_are_resolved_once(self):
+        expression = Case([(Q(integer__gt=0), "positive")],
+                          default="other",
+                          output_field=CharField()).resolve_expression(self.query)
+        alias_refcount = dict(self.query.alias_refcount)
+        alias_map = dict(self.query.alias_map)
+
+        first = expression.as_sql(self.compiler, self.connection)
+        self.assertEqual(expression.as_sql(self.compiler, self.connection), first)
+        self.assertEqual(self.query.alias_refcount, alias_refcount)
+        self.assertEqual(self.query.alias_map, alias_map)
+        self.assertEqual(len(expression.get_source_expressions()), 3)
+
+    def test_compiled_query_is_collected(self):
+        query = Query(CaseTestModel)
+        Filter(Count('pk'), Q(integer__gt=0)).resolve_expression(query).as_sql(
+            SQLCompiler(query, connection, 'default'), connection)
+        query_ref = weakref.ref(query)
+        del query
+        gc.collect()
+        self.assertIsNone(query_ref())
+
+    def test_relabeled_clone(self):
+        expression = Case([(Q(integer__gt=0), "positive")],
+                          output_field=CharField()).resolve_expression(self.query)
+        sql, params = expression.relabeled_clone({'tests_casetestmodel': 'U0'}).as_sql(
+            self.compiler, self.connection)
+        self.assertEqual(sql, 'CASE WHEN "U0"."integer" > %s THEN %s END')
+        self.assertEqual(params, [0, 'positive'])
+
 
 class SimpleCaseUnitTests(CaseExpressionTestCase):
     def test_values(self):
@@ -95,6 +148,157 @@ class SimpleCaseUnitTests(CaseExpressionTestCase):
             SimpleCase('integer', default='I cannot count', output_field=CharField()),
             '%s', ['I cannot count'])
 
+    def test_lookup(self):
+        self.assertGeneratedSqlEqual(
+            SimpleCase('integer', [(1, "one"), (2, "two"), (1, "uno")],
+                       default='other',
+                       output_field=CharField(),
+                       lookup=True),
+
+            'COALESCE("lookup"."column2", %s)',
+
+            ['other'])
+        self.assertEqual(
+            self.query.alias_map['lookup'].as_sql(self.compiler, self.connection),
+            ('LEFT OUTER JOIN (VALUES (%s, %s), (%s, %s)) "lookup" '
+             'ON ("lookup"."column1" = "tests_casetestmodel"."integer")',
+             [1, 'one', 2, 'two']))
+
+    def test_lookup_falls_back_to_case(self):
+        # COALESCE would replace the NULL result with the default
+        expression = SimpleCase('integer', [(1, None), (2, "two")],
+                                default='other',
+                                output_field=CharField(),
+                                lookup=True).resolve_expression(self.query)
+        sql, params = expression.as_sql(self.compiler, self.connection)
+        self.assertTrue(sql.startswith('CASE '))
+
+
+class CaseOptimizerUnitTests(CaseExpressionTestCase):
+    def test_unreachable_and_duplicate_conditions(self):
+        self.assertGeneratedSqlEqual(
+            Case([(Q(integer__gt=0), "positive"),
+                  (Q(integer__gt=0), "unreachable"),
+                  (Q(), "other"),
+                  (Q(integer=0), "zero")],
+                 output_field=CharField()),
+
+            'CASE WHEN "tests_casetestmodel"."integer" > %s THEN %s ELSE %s END',
+
+            [0, 'positive', 'other'])
+
+    def test_merge_adjacent_conditions(self):
+        self.assertGeneratedSqlEqual(
+            Case([(Q(integer=1), "small"),
+                  (Q(integer=2), "small"),
+                  (Q(integer=3), "large")],
+                 output_field=CharField()),
+
+            'CASE WHEN ("tests_casetestmodel"."integer" = %s OR "tests_casetestmodel"."integer" = %s) '
+            'THEN %s WHEN "tests_casetestmodel"."integer" = %s THEN %s END',
+
+            [1, 2, 'small', 3, 'large'])
+
+    def test_flatten_default(self):
+        self.assertGeneratedSqlEqual(
+            Case([(Q(integer=1), "one")],
+                 default=Case([(Q(integer=2), "two"),
+                               (Q(integer=3), "other")],
+                              default="other"),
+                 output_field=CharField()),
+
+            'CASE WHEN "tests_casetestmodel"."integer" = %s THEN %s '
+            'WHEN "tests_casetestmodel"."integer" = %s THEN %s ELSE %s END',
+
+            [1, 'one', 2, 'two', 'other'])
+
+    def test_simple_case_merged_into_in_lookup(self):
+        self.assertGeneratedSqlEqual(
+            SimpleCase('integer', [(1, "odd"), (3, "odd"), (1, "one"), (2, "even")],
+                       output_field=CharField()),
+
+            'CASE WHEN "tests_casetestmodel"."integer" IN (%s, %s) THEN %s '
+            'WHEN "tests_casetestmodel"."integer" = %s THEN %s END',
+
+            [1, 3, 'odd', 2, 'even'])
+
+    def test_single_result(self):
+        self.assertGeneratedSqlEqual(
+            SimpleCase('integer', [(1, "same"), (2, "same")],
+                       default="same",
+                       output_field=CharField()),
+            '%s', ['same'])
+
+    def test_q_key(self):
+        self.assertEqual(q_key(Q(integer=1, string='1')), q_key(Q(string='1', integer=1)))
+        self.assertNotEqual(q_key(Q(integer=1)), q_key(~Q(integer=1)))
+        self.assertNotEqual(q_key(Q(integer=1)), q_key(Q(integer=True)))
+        self.assertEqual(q_key(Q(integer__in=[1, 2])), q_key(Q(integer__in=(1, 2))))
+        self.assertIsNone(q_key(Q(integer__in=[{}])))
+
+    def test_expression_key(self):
+        self.assertEqual(
+            expression_key(Case([(Q(integer=1), 'one')], default='other')),
+            expression_key(Case([(Q(integer=1), 'one')], default='other')))
+        self.assertNotEqual(
+            expression_key(Case([(Q(integer=1), 'one')], default='other')),
+            expression_key(Case([(Q(integer=1), 'one')])))
+        self.assertNotEqual(
+            expression_key(SimpleCase('integer', [(1, 'one')])),
+            expression_key(SimpleCase('string', [(1, 'one')])))
+
+
+class FilterUnitTests(CaseExpressionTestCase):
+    def test_filter(self):
+        self.assertGeneratedSqlEqual(
+            Filter(Sum('integer'), Q(integer__gt=0)),
+            'SUM("tests_casetestmodel"."integer") FILTER (WHERE "tests_casetestmodel"."integer" > %s)',
+            [0])
+
+    def test_case_fallback(self):
+        class CaseFilter(Filter):
+            supports_filter = staticmethod(lambda connection: False)
+
+        self.assertGeneratedSqlEqual(
+            CaseFilter(Count('*'), Q(integer__gt=0)),
+            'COUNT(CASE WHEN "tests_casetestmodel"."integer" > %s THEN %s END)',
+            [0, 1])
+
+    def test_shared_condition(self):
+        first = Filter(Sum('integer'), Q(integer__gt=0)).resolve_expression(self.query)
+        second = Filter(Count('pk'), Q(integer__gt=0)).resolve_expression(self.query)
+        self.assertIs(first.condition, second.condition)
+
+
+class EvaluateUnitTests(TestCase):
+    def setUp(self):
+        self.rows = [CaseTestModel(integer=i, string=str(i)) for i in (-1, 0, 1, 2)]
+
+    def test_case(self):
+        self.assertEqual(
+            evaluate(Case([(Q(integer__gt=0), "positive"),
+                           (Q(integer__lt=0), "negative")],
+                          default="zero"),
+                     self.rows),
+            ['negative', 'zero', 'positive', 'positive'])
+
+    def test_simple_case(self):
+        self.assertEqual(
+            evaluate(SimpleCase('integer', [(1, F('integer') + 10), (2, F('integer') * 10)]),
+                     self.rows),
+            [None, None, 11, 20])
+
+    def test_lookups(self):
+        self.assertEqual(
+            evaluate(Case([(Q(integer__in=[0, 1]) & ~Q(string__contains='1'), 'a'),
+                           (Q(integer__isnull=True) | Q(integer__gte=F('integer') + 2), 'b'),
+                           (Q(string='2'), 'c')]),
+                     self.rows + [{'integer': None, 'string': None}]),
+            [None, 'a', None, 'c', 'b'])
+
+    def test_unsupported_lookup(self):
+        self.assertRaises(ValueError, evaluate, Case([(Q(string__startswith='1'), 'a')]), self.rows)
+
 
 class UpdateFieldListUnitTests(CaseExpressionTestCase):
     def test_objects(self):
@@ -110,7 +314,6 @@ class UpdateFieldListUnitTests(CaseExpressionTestCase):
 
             [1, 10, 2, 20, 3, 30])
 
-    @skip('Not implemented yet')
     def test_objects_type_conversion(self):
         self.assertGeneratedSqlEqual(
             UpdateModelList([CaseTestModel(pk=1, integer='10'),
@@ -129,6 +332,165 @@ class UpdateFieldListUnitTests(CaseExpressionTestCase):
             UpdateModelList([], output_field=CaseTestModel._meta.get_field('integer')),
             'NULL', ())
 
+    def test_objects_with_none(self):
+        self.assertGeneratedSqlEqual(
+            UpdateModelList([CaseTestModel(pk=1, string='one'),
+                             CaseTestModel(pk=2, string=None)],
+                            CaseTestModel._meta.get_field('string')),
+
+            'CASE "tests_casetestmodel"."id" '
+            'WHEN %s THEN %s WHEN %s THEN %s END',
+
+            [1, 'one', 2, None])
+
+    def test_objects_with_same_value(self):
+        self.assertGeneratedSqlEqual(
+            UpdateModelList([CaseTestModel(pk=1, integer=10),
+                             CaseTestModel(pk=2, integer=10),
+                             CaseTestModel(pk=3, integer=10)],
+                            CaseTestModel._meta.get_field('integer')),
+            '%s', [10])
+
+    def test_objects_grouped_by_value(self):
+        self.assertGeneratedSqlEqual(
+            UpdateModelList([CaseTestModel(pk=1, integer=10),
+                             CaseTestModel(pk=2, integer=20),
+                             CaseTestModel(pk=3, integer=10)],
+                            CaseTestModel._meta.get_field('integer')),
+
+            'CASE WHEN "tests_casetestmodel"."id" IN (%s, %s) THEN %s '
+            'WHEN "tests_casetestmodel"."id" IN (%s) THEN %s END',
+
+            [1, 3, 10, 2, 20])
+
+    def test_objects_with_same_value_and_default(self):
+        self.assertGeneratedSqlEqual(
+            UpdateModelList([CaseTestModel(pk=1, integer=10),
+                             CaseTestModel(pk=2, integer=10)],
+                            CaseTestModel._meta.get_field('integer'),
+                            default=F('integer')),
+
+            'CASE WHEN "tests_casetestmodel"."id" IN (%s, %s) THEN %s '
+            'ELSE "tests_casetestmodel"."integer" END',
+
+            [1, 2, 10])
+
+    def test_objects_with_default(self):
+        self.assertGeneratedSqlEqual(
+            UpdateModelList([CaseTestModel(pk=1, integer=10)],
+                            CaseTestModel._meta.get_field('integer'),
+                            default=F('integer')),
+
+            'CASE "tests_casetestmodel"."id" '
+            'WHEN %s THEN %s ELSE "tests_casetestmodel"."integer" END',
+
+            [1, 10])
+
+    def test_objects_with_expressions(self):
+        self.assertGeneratedSqlEqual(
+            UpdateModelList([CaseTestModel(pk=1, integer=F('integer') + 1),
+                             CaseTestModel(pk=2, integer=20)],
+                            CaseTestModel._meta.get_field('integer')),
+
+            'CASE "tests_casetestmodel"."id" '
+            'WHEN %s THEN ("tests_casetestmodel"."integer" + %s) WHEN %s THEN %s END',
+
+            [1, 1, 2, 20])
+
+
+class UpdateStrategyUnitTests(CaseExpressionTestCase):
+    def setUp(self):
+        super(UpdateStrategyUnitTests, self).setUp()
+        self.fields = [BulkUpdateQuerySetTestModel._meta.get_field('integer'),
+                       BulkUpdateQuerySetTestModel._meta.get_field('string')]
+
+    def test_unnest(self):
+        sql, params = UnnestUpdateStrategy(BulkUpdateQuerySetTestModel).as_sql(
+            [BulkUpdateQuerySetTestModel(pk=1, integer=10, string='one'),
+             BulkUpdateQuerySetTestModel(pk=2, integer=20, string='two')],
+            self.fields, self.connection)
+
+        self.assertEqual(
+            sql,
+            'UPDATE "tests_bulkupdatequerysettestmodel" '
+            'SET "integer" = "bulk_update_values"."integer", "string" = "bulk_update_values"."string" '
+            'FROM unnest(%s::integer[], %s::integer[], %s::varchar(100)[]) '
+            'AS "bulk_update_values" ("id", "integer", "string") '
+            'WHERE "tests_bulkupdatequerysettestmodel"."id" = "bulk_update_values"."id"')
+        self.assertEqual(params, [[1, 2], [10, 20], ['one', 'two']])
+
+    def test_unnest_keeps_unchanged_values(self):
+        objs = [BulkUpdateQuerySetTestModel(pk=1, integer=10, string='one'),
+                BulkUpdateQuerySetTestModel(pk=2, integer=20, string='two')]
+        sql, params = UnnestUpdateStrategy(BulkUpdateQuerySetTestModel).as_sql(
+            objs, self.fields, self.connection, changed={'integer': objs, 'string': objs[1:]})
+
+        self.assertIn(
+            '"string" = CASE WHEN "bulk_update_values"."string__changed" '
+            'THEN "bulk_update_values"."string" ELSE "tests_bulkupdatequerysettestmodel"."string" END',
+            sql)
+        self.assertIn('%s::boolean[]) AS "bulk_update_values" ("id", "integer", "string", '
+                      '"string__changed")', sql)
+        self.assertEqual(params, [[1, 2], [10, 20], ['one', 'two'], [False, True]])
+
+    def test_unnest_falls_back_to_case_for_expressions(self):
+        objs = [BulkUpdateQuerySetTestModel(pk=1, integer=F('integer') + 1, string='one')]
+        self.assertEqual(
+            UnnestUpdateStrategy(BulkUpdateQuerySetTestModel).as_sql(objs, self.fields, self.connection),
+            CaseUpdateStrategy(BulkUpdateQuerySetTestModel).as_sql(objs, self.fields, self.connection))
+
+    def test_max_batch_size(self):
+        limits = get_backend_limits(self.connection)
+        # a pk and a value per field, and a pk for the IN list
+        self.assertEqual(
+            CaseUpdateStrategy(BulkUpdateQuerySetTestModel).max_batch_size(self.fields, self.connection),
+            limits.max_params // 5)
+
+    def test_get_update_strategy(self):
+        self.assertIsInstance(
+            get_update_strategy(BulkUpdateQuerySetTestModel, self.connection), CaseUpdateStrategy)
+        with self.assertRaises(ValueError):
+            get_update_strategy(BulkUpdateQuerySetTestModel, self.connection, 'unnest')
+        with self.assertRaises(ValueError):
+            get_update_strategy(BulkUpdateQuerySetTestModel, self.connection, 'unknown')
+
+
+class AdaptiveBatchSizeUnitTests(TestCase):
+    def test_tunes_towards_target_time(self):
+        batch_size = AdaptiveBatchSize(10000, target_time=1.0, initial_size=100)
+        batch_size.record(100, 0.1)
+        self.assertEqual(batch_size.size, 192)
+        for i in range(10):
+            batch_size.record(batch_size.size, batch_size.size / 1000.0)
+        self.assertTrue(896 <= batch_size.size <= 1000, batch_size.size)
+        batch_size.record(batch_size.size, 10.0)
+        self.assertTrue(batch_size.size < 640, batch_size.size)
+
+    def test_ceiling(self):
+        batch_size = AdaptiveBatchSize(150, target_time=1.0, initial_size=200)
+        self.assertEqual(batch_size.size, 150)
+        batch_size.record(150, 0.001)
+        self.assertTrue(batch_size.size <= 150)
+
+
+class UpdateSQLCacheUnitTests(TestCase):
+    def test_lru(self):
+        cache = UpdateSQLCache(maxsize=2)
+        cache.set('a', 'SQL a')
+        cache.set('b', 'SQL b')
+        self.assertEqual(cache.get('a'), 'SQL a')
+        cache.set('c', 'SQL c')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 'SQL c')
+        self.assertEqual(cache.info(), (2, 1, 2, 2))
+
+    def test_clear(self):
+        cache = UpdateSQLCache()
+        cache.set('a', 'SQL a')
+        cache.get('a')
+        cache.clear()
+        self.assertEqual(cache.info(), (0, 0, 128, 0))
+
 
 class CaseExpressionIntegrationTests(DjangoTestCase):
     def setUp(self):
@@ -145,6 +507,44 @@ class CaseExpressionIntegrationTests(DjangoTestCase):
             [(1, 'one'), (2, 'two'), (3, 'other')],
             transform=attrgetter('id', 'text'))
 
+    def test_annotate_with_lookup(self):
+        self.assertQuerysetEqual(
+            CaseTestModel.objects.annotate(text=SimpleCase(
+                'integer', [(1, 'one'), (2, 'two')],
+                default='other',
+                output_field=models.CharField(),
+                lookup=True)).order_by('pk'),
+            [(1, 'one'), (2, 'two'), (3, 'other')],
+            transform=attrgetter('id', 'text'))
+
+    def test_lookup_with_keys_equal_in_the_database(self):
+        # '1' is the same key as 1 once it's an integer, so it's left out
+        self.assertQuerysetEqual(
+            CaseTestModel.objects.annotate(text=SimpleCase(
+                'integer', [(1, 'one'), ('1', 'uno'), (2, 'two')],
+                default='other',
+                output_field=models.CharField(),
+                lookup=True)).order_by('pk'),
+            [(1, 'one'), (2, 'two'), (3, 'other')],
+            transform=attrgetter('id', 'text'))
+
+    def test_filter_by_lookup(self):
+        queryset = CaseTestModel.objects.annotate(text=SimpleCase(
+            'integer', [(1, 'one'), (2, 'two')],
+            output_field=models.CharField(),
+            lookup=True)).filter(text__isnull=False)
+        self.assertEqual(queryset.count(), 2)
+        self.assertEqual(sorted(queryset.values_list('text', flat=True)), ['one', 'two'])
+
+    def test_annotate_optimized(self):
+        self.assertQuerysetEqual(
+            CaseTestModel.objects.annotate(text=SimpleCase(
+                'integer', [(1, 'low'), (2, 'low'), (1, 'one')],
+                default='other',
+                output_field=models.CharField())).order_by('pk'),
+            [(1, 'low'), (2, 'low'), (3, 'other')],
+            transform=attrgetter('id', 'text'))
+
     def test_annotate_with_F_object(self):
         self.assertQuerysetEqual(
             CaseTestModel.objects.annotate(f_test=SimpleCase(
@@ -196,6 +596,14 @@ class CaseExpressionIntegrationTests(DjangoTestCase):
                 ),
             {'one': 1, 'two': 2, 'three': 12})
 
+    def test_aggregate_with_filter(self):
+        self.assertEqual(
+            CaseTestModel.objects.aggregate(
+                positive=Filter(Sum('integer'), Q(integer__gt=1)),
+                positive_count=Filter(Count('pk'), Q(integer__gt=1)),
+                other_count=Filter(Count('pk'), ~Q(integer__gt=1))),
+            {'positive': 5, 'positive_count': 2, 'other_count': 1})
+
     def test_update(self):
         CaseTestModel.objects.update(
             string=Case([(Q(integer__lt=2), 'less than 2'),
@@ -219,6 +627,55 @@ class CaseExpressionIntegrationTests(DjangoTestCase):
             [(1, -2), (2, 0), (3, 6)],
             transform=attrgetter('id', 'integer'))
 
+    def test_generated_column(self):
+        expression = Case([(Q(integer__lt=2), 'low'), (Q(integer=2), 'medium')],
+                          default='high', output_field=models.CharField(max_length=10))
+        operation = AddGeneratedColumn('casetestmodel', 'priority', expression)
+        state = ProjectState.from_apps(apps)
+        new_state = state.clone()
+        operation.state_forwards('tests', new_state)
+        with connection.schema_editor() as editor:
+            operation.database_forwards('tests', editor, state, new_state)
+        try:
+            # models of the migration state read the column
+            model = new_state.apps.get_model('tests', 'casetestmodel')
+            queryset = model._default_manager.annotate(priority=expression).order_by('pk')
+            self.assertIn('."priority"', str(queryset.query))
+            self.assertQuerysetEqual(
+                queryset, [(1, 'low'), (2, 'medium'), (3, 'high')],
+                transform=attrgetter('id', 'priority'))
+            # the model itself once the column is recorded for it
+            self.assertNotIn('."priority"', str(CaseTestModel.objects.annotate(priority=expression).query))
+            materialize(CaseTestModel, 'priority', expression)
+            try:
+                queryset = CaseTestModel.objects.annotate(priority=expression).order_by('pk')
+                self.assertIn('."priority"', str(queryset.query))
+                self.assertQuerysetEqual(
+                    queryset, [(1, 'low'), (2, 'medium'), (3, 'high')],
+                    transform=attrgetter('id', 'priority'))
+                # databases the model isn't migrated on don't have the column
+                with override_settings(DATABASE_ROUTERS=[NoMigrationsRouter()]):
+                    self.assertNotIn('."priority"', str(queryset.query))
+            finally:
+                dematerialize(CaseTestModel, expression)
+        finally:
+            with connection.schema_editor() as editor:
+                operation.database_backwards('tests', editor, new_state, state)
+        self.assertNotIn('."priority"', str(CaseTestModel.objects.annotate(priority=expression).query))
+
+    def test_expression_index(self):
+        operation = AddExpressionIndex('casetestmodel', 'case_priority', SimpleCase(
+            'integer', [(1, 'one'), (2, 'two')], output_field=models.CharField()))
+        state = ProjectState.from_apps(apps)
+        with CaptureQueriesContext(connection) as captured:
+            with connection.schema_editor() as editor:
+                operation.database_forwards('tests', editor, state, state)
+        self.assertIn('CREATE INDEX "case_priority" ON "tests_casetestmodel" ((CASE "integer" WHEN 1',
+                      ' '.join(query['sql'] for query in captured.captured_queries))
+        # dropping the index fails if it wasn't created
+        with connection.schema_editor() as editor:
+            operation.database_backwards('tests', editor, state, state)
+
 
 class BulkUpdateQuerySetIntegrationTests(DjangoTestCase):
     def setUp(self):
@@ -281,3 +738,699 @@ class BulkUpdateQuerySetIntegrationTests(DjangoTestCase):
             BulkUpdateQuerySetTestModel.objects.order_by('pk'),
             [(1, 3, 'three', True), (2, 2, 'two', True), (3, 1, 'one', True)],
             transform=attrgetter('pk', 'integer', 'string', 'boolean'))
+
+    def test_bulk_update_with_case_strategy(self):
+        self.model1.integer = 10
+        self.model3.string = 'three'
+        BulkUpdateQuerySetTestModel.objects.bulk_update(
+            [self.model1, self.model3],
+            update_fields=['integer', 'string'],
+            strategy='case')
+
+        self.assertQuerysetEqual(
+            BulkUpdateQuerySetTestModel.objects.order_by('pk'),
+            [(1, 10, '1'), (2, 2, '2'), (3, 3, 'three')],
+            transform=attrgetter('pk', 'integer', 'string'))
+
+    @skipUnless(connection.vendor == 'postgresql', "Requires PostgreSQL")
+    def test_bulk_update_with_unnest_strategy(self):
+        self.model1.integer = 10
+        self.model3.string = 'three'
+        BulkUpdateQuerySetTestModel.objects.bulk_update(
+            [self.model1, self.model3],
+            update_fields=['integer', 'string'],
+            strategy='unnest')
+
+        self.assertQuerysetEqual(
+            BulkUpdateQuerySetTestModel.objects.order_by('pk'),
+            [(1, 10, '1'), (2, 2, '2'), (3, 3, 'three')],
+            transform=attrgetter('pk', 'integer', 'string'))
+
+    def test_duplicate_pks_keep_the_first_instance(self):
+        for name, strategy in sorted(update_strategies.items()):
+            if strategy.vendors is not None and connection.vendor not in strategy.vendors:
+                continue
+            # the later instance of model1 shares its value with model2
+            objs = [BulkUpdateQuerySetTestModel(pk=self.model2.pk, integer=20, string=name),
+                    BulkUpdateQuerySetTestModel(pk=self.model1.pk, integer=10, string=name),
+                    BulkUpdateQuerySetTestModel(pk=self.model1.pk, integer=20, string=name)]
+            BulkUpdateQuerySetTestModel.objects.bulk_update(
+                objs, update_fields=['integer', 'string'], strategy=name)
+            self.assertQuerysetEqual(
+                BulkUpdateQuerySetTestModel.objects.order_by('pk'),
+                [(10, name), (20, name), (3, '3')],
+                transform=attrgetter('integer', 'string'))
+
+    def test_bulk_update_with_staging_strategy(self):
+        objs = list(BulkUpdateQuerySetTestModel.objects.order_by('pk'))
+        for obj in objs:
+            obj.integer += 10
+            obj.string += 'x'
+        objs[2].string = F('integer')
+        with CaptureQueriesContext(connection) as queries:
+            rows = BulkUpdateQuerySetTestModel.objects.bulk_update(
+                objs, update_fields=['integer', 'string'], strategy='staging', batch_size=2)
+        self.assertEqual(rows, 3)
+        self.assertIn('CREATE TEMPORARY TABLE', queries[0]['sql'])
+        self.assertIn('DROP TABLE', queries[-1]['sql'])
+        self.assertEqual(
+            list(BulkUpdateQuerySetTestModel.objects.order_by('pk').values_list('integer', 'string')),
+            [(11, '1x'), (12, '2x'), (13, '3')])
+
+    def test_bulk_update_picks_staging_strategy(self):
+        objs = list(BulkUpdateQuerySetTestModel.objects.all())
+        queryset = BulkUpdateQuerySetTestModel.objects.all()
+        queryset.staging_threshold = 3
+        with CaptureQueriesContext(connection) as queries:
+            queryset.bulk_update(objs, update_fields=['integer'])
+        self.assertIn('CREATE TEMPORARY TABLE', queries[0]['sql'])
+        with CaptureQueriesContext(connection) as queries:
+            queryset.bulk_update(objs, update_fields=['integer'], version_field='version')
+        self.assertFalse(any('TEMPORARY' in q['sql'] for q in queries))
+
+    def test_staging_fallback_within_backend_limits(self):
+        BulkUpdateQuerySetTestModel.objects.bulk_create(
+            [BulkUpdateQuerySetTestModel(integer=i, string='') for i in range(600)])
+        objs = list(BulkUpdateQuerySetTestModel.objects.all())
+        for obj in objs:
+            obj.integer = F('integer') + 1
+        limit = StagingUpdateStrategy(BulkUpdateQuerySetTestModel).batch_limit(
+            objs, [BulkUpdateQuerySetTestModel._meta.get_field('integer')], connection)
+        with CaptureQueriesContext(connection) as queries:
+            rows = BulkUpdateQuerySetTestModel.objects.bulk_update(
+                objs, update_fields=['integer'], strategy='staging')
+        self.assertEqual(rows, 603)
+        if limit is not None:
+            self.assertEqual(len([q for q in queries if 'UPDATE' in q['sql']]), -(-603 // limit))
+
+    def test_staging_keeps_unchanged_values(self):
+        objs = list(BulkUpdateQuerySetTestModel.objects.track_changes().order_by('pk'))
+        objs[0].integer = 10
+        objs[1].string = 'two'
+        # changed since the instances were loaded
+        BulkUpdateQuerySetTestModel.objects.filter(pk=objs[1].pk).update(integer=20)
+        BulkUpdateQuerySetTestModel.objects.bulk_update(objs, only_changed=True, strategy='staging')
+        self.assertEqual(
+            list(BulkUpdateQuerySetTestModel.objects.order_by('pk').values_list('integer', 'string')),
+            [(10, '1'), (20, 'two'), (3, '3')])
+
+    def test_staging_table_dropped_after_error(self):
+        class FailingStrategy(StagingUpdateStrategy):
+            def execute_sql(self, sql, params, connection):
+                raise ValueError('failed')
+        with CaptureQueriesContext(connection) as queries:
+            with self.assertRaises(ValueError):
+                BulkUpdateQuerySetTestModel.objects.bulk_update(
+                    BulkUpdateQuerySetTestModel.objects.all(), update_fields=['integer'],
+                    strategy=FailingStrategy)
+        self.assertTrue(any('DROP TABLE' in q['sql'] for q in queries))
+
+    def test_bulk_update_uses_cached_sql(self):
+        model4 = BulkUpdateQuerySetTestModel.objects.create(integer=4, string='4')
+        update_sql_cache.clear()
+        for i, obj in enumerate([self.model1, self.model2, self.model3, model4]):
+            obj.integer = i * 10
+        BulkUpdateQuerySetTestModel.objects.bulk_update(
+            [self.model1, self.model2, self.model3, model4],
+            update_fields=['integer'], batch_size=2, strategy='case')
+
+        self.assertEqual(update_sql_cache.info()[:2], (1, 1))
+        self.assertQuerysetEqual(
+            BulkUpdateQuerySetTestModel.objects.order_by('pk'),
+            [(1, 0), (2, 10), (3, 20), (4, 30)],
+            transform=attrgetter('pk', 'integer'))
+
+    def test_bulk_update_grouped_values(self):
+        self.model1.boolean = True
+        self.model3.boolean = True
+        self.model1.string = 'same'
+        self.model2.string = 'same'
+        self.model3.string = 'same'
+        BulkUpdateQuerySetTestModel.objects.bulk_update(
+            [self.model1, self.model2, self.model3], update_fields=['boolean', 'string'])
+
+        self.assertQuerysetEqual(
+            BulkUpdateQuerySetTestModel.objects.order_by('pk'),
+            [(1, 'same', True), (2, 'same', False), (3, 'same', True)],
+            transform=attrgetter('pk', 'string', 'boolean'))
+
+    def test_bulk_update_returns_rows_matched(self):
+        self.assertEqual(
+            BulkUpdateQuerySetTestModel.objects.bulk_update(
+                [self.model1, self.model2, self.model3], update_fields=['integer']),
+            3)
+        self.assertEqual(BulkUpdateQuerySetTestModel.objects.bulk_update([]), 0)
+
+    def test_bulk_update_from_iterator(self):
+        def iter_objs():
+            for obj in BulkUpdateQuerySetTestModel.objects.order_by('pk').iterator():
+                obj.integer *= 10
+                yield obj
+
+        self.assertEqual(
+            BulkUpdateQuerySetTestModel.objects.bulk_update(
+                iter_objs(), update_fields=['integer'], batch_size=2),
+            3)
+        self.assertQuerysetEqual(
+            BulkUpdateQuerySetTestModel.objects.order_by('pk'),
+            [(1, 10), (2, 20), (3, 30)],
+            transform=attrgetter('pk', 'integer'))
+
+    def test_bulk_update_without_pk(self):
+        self.model1.integer = 10
+        objs = iter([self.model1, BulkUpdateQuerySetTestModel(integer=4, string='4')])
+        with self.assertRaises(ValueError), transaction.atomic():
+            BulkUpdateQuerySetTestModel.objects.bulk_update(
+                objs, update_fields=['integer'], batch_size=1)
+        self.assertEqual(BulkUpdateQuerySetTestModel.objects.get(pk=1).integer, 1)
+
+    def test_bulk_update_only_changed(self):
+        objs = list(BulkUpdateQuerySetTestModel.objects.track_changes().order_by('pk'))
+        objs[0].integer = 10
+        objs[2].string = 'three'
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(
+                BulkUpdateQuerySetTestModel.objects.bulk_update(objs, strategy='case', only_changed=True),
+                2)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('"boolean"', queries[0]['sql'])
+        self.assertQuerysetEqual(
+            BulkUpdateQuerySetTestModel.objects.order_by('pk'),
+            [(1, 10, '1'), (2, 2, '2'), (3, 3, 'three')],
+            transform=attrgetter('pk', 'integer', 'string'))
+
+        # the snapshots are updated, so nothing is left to update
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(
+                BulkUpdateQuerySetTestModel.objects.bulk_update(objs, only_changed=True), 0)
+        self.assertEqual(len(queries), 0)
+
+    def test_bulk_update_with_batch_time(self):
+        for obj in (self.model1, self.model2, self.model3):
+            obj.integer *= 10
+        self.assertEqual(
+            BulkUpdateQuerySetTestModel.objects.bulk_update(
+                [self.model1, self.model2, self.model3], update_fields=['integer'], batch_time=0.5),
+            3)
+        self.assertQuerysetEqual(
+            BulkUpdateQuerySetTestModel.objects.order_by('pk'),
+            [(1, 10), (2, 20), (3, 30)],
+            transform=attrgetter('pk', 'integer'))
+
+    def test_bulk_update_returning(self):
+        objs = list(BulkUpdateQuerySetTestModel.objects.order_by('pk'))
+        for obj in objs:
+            obj.integer = F('integer') + 10
+        with self.assertNumQueries(1 if supports_returning(connection) else 2):
+            BulkUpdateQuerySetTestModel.objects.bulk_update(
+                objs, update_fields=['integer'], returning=['integer', 'boolean'])
+        self.assertEqual([(obj.integer, obj.boolean) for obj in objs],
+                         [(11, False), (12, False), (13, False)])
+
+    def test_bulk_update_with_version_field(self):
+        objs = list(BulkUpdateQuerySetTestModel.objects.order_by('pk'))
+        BulkUpdateQuerySetTestModel.objects.filter(pk=self.model2.pk).update(version=1)
+        for obj in objs:
+            obj.integer += 10
+        with CaptureQueriesContext(connection) as queries:
+            result = BulkUpdateQuerySetTestModel.objects.bulk_update(
+                objs, update_fields=['integer'], version_field='version', strategy='case')
+        # the versions are compared with a CASE expression, not one condition per row
+        self.assertNotIn(' OR ', queries[0]['sql'])
+        self.assertEqual(result, 2)
+        self.assertEqual(result.stale, [objs[1]])
+        self.assertEqual([obj.version for obj in objs], [1, 0, 1])
+        self.assertEqual(
+            list(BulkUpdateQuerySetTestModel.objects.order_by('pk').values_list('integer', 'version')),
+            [(11, 1), (2, 1), (13, 1)])
+
+    def test_bulk_update_values(self):
+        with self.assertNumQueries(1):
+            rows = BulkUpdateQuerySetTestModel.objects.bulk_update_values(
+                [(self.model1.pk, 10, 'a'), (self.model3.pk, 30, 'c')], ['integer', 'string'])
+        self.assertEqual(rows, 2)
+        BulkUpdateQuerySetTestModel.objects.bulk_update_values(
+            {self.model2.pk: {'integer': 20}}, ['integer'])
+        self.assertEqual(
+            list(BulkUpdateQuerySetTestModel.objects.order_by('pk').values_list('integer', 'string')),
+            [(10, 'a'), (20, '2'), (30, 'c')])
+        self.assertRaises(ValueError, BulkUpdateQuerySetTestModel.objects.bulk_update_values,
+                          {self.model2.pk: {'string': 'b'}}, ['integer'])
+
+    def test_bulk_update_values_with_wrong_row_length(self):
+        with self.assertNumQueries(0):
+            self.assertRaises(ValueError, BulkUpdateQuerySetTestModel.objects.bulk_update_values,
+                              [(self.model1.pk, 10), (self.model2.pk, 20, 'b', True)],
+                              ['integer', 'string'])
+        self.assertRaises(ValueError, BulkUpdateQuerySetTestModel.objects.bulk_update_values,
+                          iter([(self.model1.pk, 10)]), ['integer', 'string'])
+
+    def test_bulk_update_batch_signal(self):
+        batches = []
+
+        def receiver(sender, **kwargs):
+            batches.append(kwargs)
+
+        bulk_update_batch.connect(receiver, sender=BulkUpdateQuerySetTestModel)
+        try:
+            BulkUpdateQuerySetTestModel.objects.bulk_update(
+                [self.model1, self.model2, self.model3],
+                update_fields=['integer', 'string'], batch_size=2, strategy='case')
+        finally:
+            bulk_update_batch.disconnect(receiver, sender=BulkUpdateQuerySetTestModel)
+
+        self.assertEqual(
+            [(b['batch'], b['objects'], b['rows'], b['params']) for b in batches],
+            [(0, 2, 2, 10), (1, 1, 1, 5)])
+        for b in batches:
+            self.assertEqual(b['using'], 'default')
+            self.assertTrue(b['sql_length'] > 0)
+            self.assertTrue(b['build_time'] >= 0)
+            self.assertTrue(b['execute_time'] >= 0)
+
+    def test_bulk_update_batch_signal_times_prepare_as_execution(self):
+        batches = []
+
+        class SlowStagingStrategy(StagingUpdateStrategy):
+            def prepare(self, *args, **kwargs):
+                super(SlowStagingStrategy, self).prepare(*args, **kwargs)
+                time.sleep(0.05)
+
+        def receiver(sender, **kwargs):
+            batches.append(kwargs)
+
+        bulk_update_batch.connect(receiver, sender=BulkUpdateQuerySetTestModel)
+        try:
+            BulkUpdateQuerySetTestModel.objects.bulk_update(
+                [self.model1, self.model2], update_fields=['integer'], strategy=SlowStagingStrategy)
+        finally:
+            bulk_update_batch.disconnect(receiver, sender=BulkUpdateQuerySetTestModel)
+        self.assertEqual(len(batches), 1)
+        self.assertTrue(batches[0]['build_time'] < 0.05)
+        self.assertTrue(batches[0]['execute_time'] >= 0.05)
+
+
+class InheritedBulkUpdateIntegrationTests(DjangoTestCase):
+    def setUp(self):
+        # the pks of the second parent differ from the child's
+        BulkUpdateOtherParentTestModel.objects.create()
+        self.objs = [BulkUpdateChildTestModel.objects.create(integer=i, string=str(i))
+                     for i in range(3)]
+
+    def test_bulk_update(self):
+        for obj in self.objs:
+            obj.integer += 10
+            obj.boolean = True
+            obj.string = 'updated'
+        with CaptureQueriesContext(connection) as captured:
+            rows = BulkUpdateChildTestModel.objects.bulk_update(self.objs)
+        self.assertEqual(rows, 3)
+        self.assertEqual(len([q for q in captured.captured_queries if 'UPDATE' in q['sql']]), 3)
+        self.assertQuerysetEqual(
+            BulkUpdateChildTestModel.objects.order_by('pk'),
+            [(10, True, 'updated'), (11, True, 'updated'), (12, True, 'updated')],
+            transform=attrgetter('integer', 'boolean', 'string'))
+        self.assertEqual(BulkUpdateOtherParentTestModel.objects.filter(boolean=True).count(), 3)
+
+    def test_instances_constructed_with_pk(self):
+        objs = [BulkUpdateChildTestModel(
+            pk=obj.pk, bulkupdateotherparenttestmodel_ptr_id=obj.bulkupdateotherparenttestmodel_ptr_id,
+            integer=obj.integer + 100, boolean=True, string='updated') for obj in self.objs]
+        # compile the SQL instead of reusing it
+        update_sql_cache.clear()
+        rows = BulkUpdateChildTestModel.objects.bulk_update(objs, strategy='case')
+        self.assertEqual(rows, 3)
+        self.assertQuerysetEqual(
+            BulkUpdateChildTestModel.objects.order_by('pk'),
+            [(100, True, 'updated'), (101, True, 'updated'), (102, True, 'updated')],
+            transform=attrgetter('integer', 'boolean', 'string'))
+
+    def test_bulk_update_batch_signal(self):
+        batches = []
+
+        def receiver(sender, **kwargs):
+            batches.append(kwargs)
+
+        bulk_update_batch.connect(receiver, sender=BulkUpdateChildTestModel)
+        try:
+            with CaptureQueriesContext(connection) as captured:
+                BulkUpdateChildTestModel.objects.bulk_update(self.objs, batch_size=2)
+        finally:
+            bulk_update_batch.disconnect(receiver, sender=BulkUpdateChildTestModel)
+
+        updates = [q['sql'] for q in captured.captured_queries if 'UPDATE' in q['sql']]
+        self.assertEqual(len(updates), 6)
+        self.assertEqual([(b['batch'], b['objects'], b['rows'], b['params']) for b in batches],
+                         [(0, 2, 2, 15), (1, 1, 1, 9)])
+
+    def test_tables_without_fields_are_skipped(self):
+        for obj in self.objs:
+            obj.boolean = True
+        with CaptureQueriesContext(connection) as captured:
+            rows = BulkUpdateChildTestModel.objects.bulk_update(self.objs, update_fields=['boolean'])
+        self.assertEqual(rows, 3)
+        updates = [q['sql'] for q in captured.captured_queries if 'UPDATE' in q['sql']]
+        self.assertEqual(len(updates), 1)
+        self.assertIn(BulkUpdateOtherParentTestModel._meta.db_table, updates[0])
+        self.assertEqual(
+            [obj.boolean for obj in BulkUpdateOtherParentTestModel.objects.order_by('pk')],
+            [False, True, True, True])
+
+    def test_only_changed(self):
+        objs = list(BulkUpdateChildTestModel.objects.track_changes().order_by('pk'))
+        objs[0].integer = -1
+        objs[1].string = 'updated'
+        with CaptureQueriesContext(connection) as captured:
+            BulkUpdateChildTestModel.objects.bulk_update(objs, only_changed=True)
+        self.assertEqual(len([q for q in captured.captured_queries if 'UPDATE' in q['sql']]), 2)
+        self.assertQuerysetEqual(
+            BulkUpdateChildTestModel.objects.order_by('pk'),
+            [(-1, '0'), (1, 'updated'), (2, '2')],
+            transform=attrgetter('integer', 'string'))
+
+
+class BulkUpsertIntegrationTests(DjangoTestCase):
+    def setUp(self):
+        self.existing = BulkUpsertTestModel.objects.create(key='a', integer=1, string='a')
+
+    def get_objs(self):
+        return [BulkUpsertTestModel(key='a', integer=10, string='x'),
+                BulkUpsertTestModel(key='b', integer=2, string='b'),
+                BulkUpsertTestModel(key='b', integer=20, string='b')]
+
+    def assertRows(self, expected):
+        self.assertEqual(
+            list(BulkUpsertTestModel.objects.order_by('key').values_list('key', 'integer', 'string')),
+            expected)
+
+    @skipUnless(supports_upsert(connection), "The backend doesn't support upserts")
+    def test_bulk_upsert(self):
+        with self.assertNumQueries(1):
+            BulkUpsertTestModel.objects.bulk_upsert(self.get_objs(), ['key'], update_fields=['integer'])
+        self.assertRows([('a', 10, 'a'), ('b', 20, 'b')])
+        self.assertEqual(BulkUpsertTestModel.objects.get(key='a').pk, self.existing.pk)
+
+    @skipUnless(supports_upsert(connection), "The backend doesn't support upserts")
+    def test_bulk_upsert_without_update_fields(self):
+        BulkUpsertTestModel.objects.bulk_upsert(self.get_objs(), ['key'], update_fields=[])
+        self.assertRows([('a', 1, 'a'), ('b', 20, 'b')])
+
+    def test_bulk_upsert_keeps_auto_now_add_fields(self):
+        created = datetime.datetime(2000, 1, 1)
+        BulkUpsertTestModel.objects.filter(pk=self.existing.pk).update(created=created)
+        BulkUpsertTestModel.objects.bulk_upsert(self.get_objs(), ['key'])
+        self.assertRows([('a', 10, 'x'), ('b', 20, 'b')])
+        self.assertEqual(BulkUpsertTestModel.objects.get(key='a').created, created)
+        self.assertNotEqual(BulkUpsertTestModel.objects.get(key='b').created, created)
+
+    def test_select_and_upsert(self):
+        opts = BulkUpsertTestModel._meta
+        rows = BulkUpsertTestModel.objects.all()._select_and_upsert(
+            self.get_objs(), [opts.get_field('key')], [opts.get_field('integer')], None)
+        self.assertEqual(rows, 2)
+        self.assertRows([('a', 10, 'a'), ('b', 20, 'b')])
+
+    def test_select_and_upsert_in_batches(self):
+        opts = BulkUpsertTestModel._meta
+        # the second batch updates the row the first one created
+        rows = BulkUpsertTestModel.objects.all()._select_and_upsert(
+            iter(self.get_objs()), [opts.get_field('key')], [opts.get_field('integer')], 2)
+        self.assertEqual(rows, 3)
+        self.assertRows([('a', 10, 'a'), ('b', 20, 'b')])
+
+
+# whether other threads' connections see the test database, which they
+# can't if it's in memory and not shared
+shares_test_db = (connection.features.test_db_allows_multiple_connections or
+                  getattr(connection.features, 'can_share_in_memory_db', False))
+
+
+class BatchTransactionIntegrationTests(TransactionTestCase):
+    def setUp(self):
+        self.objs = [BulkUpdateQuerySetTestModel.objects.create(integer=i, string=str(i))
+                     for i in range(6)]
+
+    def test_batches_sorted_by_pk(self):
+        batches = []
+
+        class RecordingStrategy(CaseUpdateStrategy):
+            def as_sql(self, objs, *args, **kwargs):
+                batches.append([o.pk for o in objs])
+                return super(RecordingStrategy, self).as_sql(objs, *args, **kwargs)
+        for obj in self.objs:
+            obj.integer += 1
+        completed = set()
+        rows = BulkUpdateQuerySetTestModel.objects.bulk_update(
+            reversed(self.objs), update_fields=['integer'], batch_size=4,
+            strategy=RecordingStrategy, transaction_scope='batch', completed_batches=completed)
+        self.assertEqual(rows, 6)
+        self.assertEqual(completed, {0, 1})
+        self.assertEqual(batches, [[o.pk for o in self.objs[2:]], [o.pk for o in self.objs[:2]]])
+        self.assertEqual(
+            list(BulkUpdateQuerySetTestModel.objects.order_by('pk').values_list('integer', flat=True)),
+            list(range(1, 7)))
+
+    def test_resume(self):
+        for obj in self.objs:
+            obj.string = 'updated'
+        rows = BulkUpdateQuerySetTestModel.objects.bulk_update(
+            self.objs, update_fields=['string'], batch_size=4, transaction_scope='batch',
+            completed_batches={0})
+        self.assertEqual(rows, 2)
+        self.assertEqual(
+            list(BulkUpdateQuerySetTestModel.objects.filter(string='updated').values_list('pk', flat=True)
+                 .order_by('pk')),
+            [obj.pk for obj in self.objs[4:]])
+
+    def test_retry_after_deadlock(self):
+        class FlakyStrategy(CaseUpdateStrategy):
+            failures = 1
+
+            def execute_sql(self, sql, params, connection):
+                if FlakyStrategy.failures:
+                    FlakyStrategy.failures -= 1
+                    raise OperationalError('database is locked')
+                return super(FlakyStrategy, self).execute_sql(sql, params, connection)
+        for obj in self.objs:
+            obj.integer = -1
+        queryset = BulkUpdateQuerySetTestModel.objects.all()
+        queryset.retry_delay = 0
+        self.assertEqual(queryset.bulk_update(self.objs, update_fields=['integer'],
+                                              strategy=FlakyStrategy, transaction_scope='batch'), 6)
+        self.assertEqual(BulkUpdateQuerySetTestModel.objects.filter(integer=-1).count(), 6)
+
+    def flaky_queryset(self):
+        queryset = BulkUpdateQuerySetTestModel.objects.all()
+        queryset.retry_delay = 0
+        update_batch = queryset._update_batch
+        failures = [OperationalError('database is locked')]
+
+        def flaky_update_batch(*args, **kwargs):
+            # fails after the instances are updated, like a deadlock on commit
+            rows = update_batch(*args, **kwargs)
+            if failures:
+                raise failures.pop()
+            return rows
+        queryset._update_batch = flaky_update_batch
+        return queryset
+
+    def test_retry_restores_instances(self):
+        for obj in self.objs:
+            obj.integer = -1
+        result = self.flaky_queryset().bulk_update(
+            self.objs, update_fields=['integer'], version_field='version',
+            transaction_scope='batch')
+        self.assertEqual(result, 6)
+        self.assertEqual(result.stale, [])
+        self.assertEqual([obj.version for obj in self.objs], [1] * 6)
+        self.assertEqual(BulkUpdateQuerySetTestModel.objects.filter(integer=-1, version=1).count(), 6)
+
+    def test_retry_with_staging_strategy(self):
+        for obj in self.objs:
+            obj.integer = -1
+        self.assertEqual(self.flaky_queryset().bulk_update(
+            self.objs, update_fields=['integer'], strategy='staging', transaction_scope='batch'), 6)
+        self.assertEqual(BulkUpdateQuerySetTestModel.objects.filter(integer=-1).count(), 6)
+
+    def failing_queryset(self, queryset):
+        update_batch = queryset._update_batch
+
+        def failing_update_batch(objs, tables, only_changed=False, index=None, *args, **kwargs):
+            if index == 1:
+                raise OperationalError('disk I/O error')
+            return update_batch(objs, tables, only_changed, index, *args, **kwargs)
+        queryset._update_batch = failing_update_batch
+        return queryset
+
+    def test_rollback_restores_snapshots(self):
+        objs = list(BulkUpdateQuerySetTestModel.objects.track_changes().order_by('pk')[:4])
+        for obj in objs:
+            obj.integer += 10
+        with self.assertRaises(OperationalError):
+            self.failing_queryset(BulkUpdateQuerySetTestModel.objects.all()).bulk_update(
+                objs, batch_size=2, only_changed=True)
+        # the first batch was rolled back too, so it's still changed
+        self.assertEqual(BulkUpdateQuerySetTestModel.objects.bulk_update(
+            objs, batch_size=2, only_changed=True), 4)
+        self.assertEqual(
+            list(BulkUpdateQuerySetTestModel.objects.order_by('pk').values_list('integer', flat=True)),
+            [10, 11, 12, 13, 4, 5])
+
+    def test_rollback_restores_versions_and_returned_values(self):
+        for obj in self.objs:
+            obj.integer = F('integer') + 10
+        with self.assertRaises(OperationalError):
+            self.failing_queryset(BulkUpdateQuerySetTestModel.objects.all()).bulk_update(
+                self.objs, update_fields=['integer'], batch_size=2, version_field='version',
+                returning=['integer'])
+        self.assertEqual([obj.version for obj in self.objs], [0] * 6)
+        self.assertTrue(all(hasattr(obj.integer, 'resolve_expression') for obj in self.objs))
+        result = BulkUpdateQuerySetTestModel.objects.bulk_update(
+            self.objs, update_fields=['integer'], batch_size=2, version_field='version',
+            returning=['integer'])
+        self.assertEqual(result.stale, [])
+        self.assertEqual([(obj.integer, obj.version) for obj in self.objs],
+                         [(i + 10, 1) for i in range(6)])
+
+    @skipUnless(shares_test_db, "Requires a test database that other threads can use")
+    def test_single_worker(self):
+        # the in-memory test database can't take concurrent writers
+        for obj in self.objs:
+            obj.integer = -1
+        result = BulkUpdateQuerySetTestModel.objects.bulk_update(
+            self.objs, update_fields=['integer'], batch_size=4, workers=1)
+        self.assertEqual(result, 6)
+        self.assertEqual([stats.objects for stats in result.workers], [6])
+        self.assertEqual(BulkUpdateQuerySetTestModel.objects.filter(integer=-1).count(), 6)
+
+    def test_no_workers_inside_transaction(self):
+        with transaction.atomic():
+            with self.assertRaises(TransactionManagementError):
+                BulkUpdateQuerySetTestModel.objects.bulk_update(
+                    self.objs, update_fields=['integer'], workers=2)
+
+    def test_no_retry_inside_transaction(self):
+        class FailingStrategy(CaseUpdateStrategy):
+            def execute_sql(self, sql, params, connection):
+                raise OperationalError('database is locked')
+        with self.assertRaises(OperationalError):
+            with transaction.atomic():
+                BulkUpdateQuerySetTestModel.objects.bulk_update(
+                    self.objs, update_fields=['integer'], strategy=FailingStrategy,
+                    transaction_scope='batch')
+
+
+@skipUnless(connection.features.test_db_allows_multiple_connections,
+            "Requires a database that allows multiple connections")
+class ParallelBulkUpdateIntegrationTests(TransactionTestCase):
+    def setUp(self):
+        self.objs = [BulkUpdateQuerySetTestModel.objects.create(integer=i, string=str(i))
+                     for i in range(10)]
+
+    def test_bulk_update(self):
+        for obj in self.objs:
+            obj.integer *= 10
+        result = BulkUpdateQuerySetTestModel.objects.bulk_update(
+            reversed(self.objs), update_fields=['integer'], batch_size=2, workers=3)
+
+        self.assertEqual(result, 10)
+        self.assertEqual([stats.objects for stats in result.workers], [4, 4, 2])
+        self.assertEqual(
+            [(stats.first_pk, stats.last_pk) for stats in result.workers],
+            [(self.objs[0].pk, self.objs[3].pk),
+             (self.objs[4].pk, self.objs[7].pk),
+             (self.objs[8].pk, self.objs[9].pk)])
+        self.assertEqual(
+            list(BulkUpdateQuerySetTestModel.objects.order_by('pk').values_list('integer', flat=True)),
+            [i * 10 for i in range(10)])
+
+    def test_bulk_update_with_batch_transactions(self):
+        for obj in self.objs:
+            obj.string = 'updated'
+        self.assertEqual(
+            BulkUpdateQuerySetTestModel.objects.bulk_update(
+                self.objs, update_fields=['string'], batch_size=3, workers=2,
+                transaction_scope='batch'),
+            10)
+        self.assertEqual(BulkUpdateQuerySetTestModel.objects.filter(string='updated').count(), 10)
+
+
+@skipUnless(hasattr(BulkUpdateQuerySetTestModel.objects, 'abulk_update'), "Requires asyncio")
+@skipUnless(shares_test_db, "Requires a test database that other threads can use")
+class AsyncBulkUpdateIntegrationTests(TransactionTestCase):
+    def setUp(self):
+        self.objs = [BulkUpdateQuerySetTestModel.objects.create(integer=i, string=str(i))
+                     for i in range(10)]
+
+    def test_abulk_update(self):
+        import asyncio
+        for obj in self.objs:
+            obj.integer += 1
+        rows = asyncio.get_event_loop().run_until_complete(
+            BulkUpdateQuerySetTestModel.objects.abulk_update(
+                self.objs, update_fields=['integer'], batch_size=3))
+        self.assertEqual(rows, 10)
+        self.assertEqual(
+            list(BulkUpdateQuerySetTestModel.objects.order_by('pk').values_list('integer', flat=True)),
+            list(range(1, 11)))
+
+    def test_abulk_update_rolls_back_on_error(self):
+        import asyncio
+        objs = self.objs
+
+        class Objects(object):
+            # an async iterator that fails after the first two batches
+            index = 0
+
+            def __aiter__(self):
+                return self
+
+            def __anext__(self):
+                future = asyncio.Future()
+                if self.index == 6:
+                    future.set_exception(ValueError('failed'))
+                else:
+                    objs[self.index].string = 'updated'
+                    future.set_result(objs[self.index])
+                    self.index += 1
+                return future
+        with self.assertRaises(ValueError):
+            asyncio.get_event_loop().run_until_complete(
+                BulkUpdateQuerySetTestModel.objects.abulk_update(
+                    Objects(), update_fields=['string'], batch_size=2))
+        self.assertFalse(BulkUpdateQuerySetTestModel.objects.filter(string='updated').exists())
+
+    def test_abulk_update_with_staging_strategy(self):
+        import asyncio
+        batches = []
+        tables = []
+
+        class RecordingStrategy(StagingUpdateStrategy):
+            def finish(self, connection):
+                tables.append(self.table)
+                super(RecordingStrategy, self).finish(connection)
+
+        def receiver(sender, batch, objects, **kwargs):
+            batches.append((batch, objects))
+
+        def objs():
+            for obj in self.objs:
+                obj.string = 'updated'
+                yield obj
+            raise ValueError('failed')
+
+        bulk_update_batch.connect(receiver, sender=BulkUpdateQuerySetTestModel)
+        try:
+            with self.assertRaises(ValueError):
+                asyncio.get_event_loop().run_until_complete(
+                    BulkUpdateQuerySetTestModel.objects.abulk_update(
+                        objs(), update_fields=['string'], batch_size=4,
+                        strategy=RecordingStrategy))
+        finally:
+            bulk_update_batch.disconnect(receiver, sender=BulkUpdateQuerySetTestModel)
+        self.assertEqual(batches, [(0, 4), (1, 4)])
+        # the staging table is dropped after the error too
+        self.assertEqual(len(tables), 1)
+        self.assertIsNotNone(tables[0])
+        self.assertFalse(BulkUpdateQuerySetTestModel.objects.filter(string='updated').exists())